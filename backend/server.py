@@ -1,15 +1,33 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect
 from dotenv import load_dotenv
+from fastapi.responses import StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
+import asyncio
+import base64
+import csv
+import hashlib
+import importlib
+import io
+import json
+import math
+import re
+import zlib
+import time
+import heapq
+from collections import OrderedDict, deque
 from pathlib import Path
+import numpy as np
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from enum import Enum
+from abc import ABC, abstractmethod
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -41,6 +59,11 @@ class ToolType(str, Enum):
     FORM_GENERATOR = "form_generator"
     PLANNER = "planner"
 
+class XPEventKind(str, Enum):
+    GLOSSARY_VIEW = "glossary_view"
+    QUIZ_COMPLETION = "quiz_completion"
+    OPENING_BALANCE = "opening_balance"  # Totals carried over from before the ledger existed
+
 # Data Models
 class CourseContent(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -98,9 +121,20 @@ class UserXP(BaseModel):
     total_xp: int = 0
     quiz_xp: int = 0
     glossary_xp: int = 0
+    ledger_seeded: bool = True  # False only for records that predate the XP ledger
+    compacted_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     last_updated: datetime = Field(default_factory=datetime.utcnow)
 
+class XPEvent(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    kind: XPEventKind
+    category: str  # Snapshot bucket: "quiz_xp" or "glossary_xp"
+    points: int
+    ref_id: Optional[str] = None  # Glossary term or quiz question
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
 class MarketplaceItem(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -120,6 +154,15 @@ class UserProgress(BaseModel):
     score: Optional[int] = None
     completed_at: Optional[datetime] = None
 
+class CourseProgressSummary(BaseModel):
+    user_id: str
+    course_id: str
+    completed_lessons: int = 0
+    total_lessons: int = 0
+    completion_percentage: float = 0
+    total_score: int = 0
+    last_activity: Optional[datetime] = None
+
 class ChatMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
@@ -129,12 +172,19 @@ class ChatMessage(BaseModel):
     is_starred: bool = False
     context_modules: List[str] = []
     context_glossary: List[str] = []
+    context_lessons: List[Dict[str, Any]] = []  # {course_id, lesson_id, title, label} for each linked lesson
+    context_passages: List[Dict[str, Any]] = []  # Lesson passages the response was grounded in
 
 class ChatThread(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     title: str
-    messages: List[ChatMessage] = []
+    messages: List[ChatMessage] = []  # Most recent messages only; full history is in chat_messages
+    message_count: int = 0
+    summary: str = ""  # Rolling summary of the first summarized_count messages
+    summary_topics: List[Dict[str, Any]] = []  # [{"topic", "count"}], most discussed first
+    summary_questions: List[str] = []
+    summarized_count: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
     last_updated: datetime = Field(default_factory=datetime.utcnow)
     is_starred: bool = False
@@ -231,12 +281,15 @@ async def get_tool(tool_id: str):
 # XP tracking endpoints
 @api_router.get("/users/xp/{user_id}")
 async def get_user_xp(user_id: str):
-    user_xp = await db.user_xp.find_one({"user_id": user_id})
-    if not user_xp:
-        # Create default XP record if it doesn't exist
-        new_xp = UserXP(user_id=user_id)
-        await db.user_xp.insert_one(new_xp.dict())
-        return new_xp
+    # Create the default XP record on first visit in the same round trip
+    defaults = UserXP(user_id=user_id).dict()
+    defaults.pop("user_id")
+    user_xp = await db.user_xp.find_one_and_update(
+        {"user_id": user_id},
+        {"$setOnInsert": defaults},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
     return UserXP(**user_xp)
 
 @api_router.get("/users/xp")
@@ -248,48 +301,519 @@ class XPRequest(BaseModel):
     term_id: Optional[str] = None
     points: Optional[int] = None
 
-@api_router.post("/users/xp/glossary")
-async def award_glossary_xp(request: XPRequest):
-    """Award 5 XP for viewing a glossary term"""
-    user_xp = await db.user_xp.find_one({"user_id": request.user_id})
-    if not user_xp:
-        new_xp = UserXP(user_id=request.user_id, glossary_xp=5, total_xp=5)
-        await db.user_xp.insert_one(new_xp.dict())
-        return {"status": "success", "xp_earned": 5, "total_xp": 5}
+GLOSSARY_XP_POINTS = 5
+
+class BloomFilter:
+    """Compact probabilistic set: no false negatives, rare false positives."""
+
+    def __init__(self, num_bits: int = 2048, num_hashes: int = 4):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+# Per-user filters of glossary terms already claimed. The glossary_xp_awards
+# collection (unique on user_id + term_id) stays the source of truth; the
+# filter only lets repeat views skip the write path. Filters for the least
+# recently active users are dropped once the cache is full.
+GLOSSARY_SEEN_MAX_USERS = 10000
+glossary_xp_seen: "OrderedDict[str, BloomFilter]" = OrderedDict()
+
+async def _increment_user_xp_snapshot(user_id: str, increments: Dict[str, int]) -> Dict[str, Any]:
+    points = sum(increments.values())
+    defaults = UserXP(user_id=user_id).dict()
+    for key in ("user_id", "total_xp", "last_updated", *increments):
+        defaults.pop(key)
+    return await db.user_xp.find_one_and_update(
+        {"user_id": user_id},
+        {
+            "$inc": {**increments, "total_xp": points},
+            "$set": {"last_updated": datetime.utcnow()},
+            "$setOnInsert": defaults
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+def _duplicate_indexes(error: BulkWriteError) -> set:
+    """Positions of a bulk write that failed only because they already exist"""
+    write_errors = error.details.get("writeErrors", [])
+    if any(e["code"] != 11000 for e in write_errors):
+        raise error
+    return {e["index"] for e in write_errors}
+
+async def apply_xp_events(user_id: str, events: List[XPEvent]) -> tuple:
+    """Append awards to the XP ledger in one bulk_write and fold the new ones into the snapshot.
+
+    Events whose id is already in the ledger are skipped, which makes
+    replaying a batch safe. Returns (applied events, snapshot document).
+    """
+    applied = events
+    if events:
+        try:
+            await db.xp_events.bulk_write([InsertOne(e.dict()) for e in events], ordered=False)
+        except BulkWriteError as e:
+            duplicates = _duplicate_indexes(e)
+            applied = [event for i, event in enumerate(events) if i not in duplicates]
+    if not applied:
+        return applied, await db.user_xp.find_one({"user_id": user_id})
+    increments: Dict[str, int] = {}
+    for event in applied:
+        increments[event.category] = increments.get(event.category, 0) + event.points
+    user_xp = await _increment_user_xp_snapshot(user_id, increments)
+    await record_xp_award(user_id, sum(increments.values()), user_xp["total_xp"])
+    return applied, user_xp
+
+async def apply_xp_event(event: XPEvent) -> Dict[str, Any]:
+    """Append an award to the XP ledger and fold it into the user's snapshot"""
+    _, user_xp = await apply_xp_events(event.user_id, [event])
+    return user_xp
+
+def _glossary_seen_filter(user_id: str) -> BloomFilter:
+    seen = glossary_xp_seen.get(user_id)
+    if seen is None:
+        seen = glossary_xp_seen[user_id] = BloomFilter()
+        if len(glossary_xp_seen) > GLOSSARY_SEEN_MAX_USERS:
+            glossary_xp_seen.popitem(last=False)
     else:
-        new_glossary_xp = user_xp["glossary_xp"] + 5
-        new_total_xp = user_xp["total_xp"] + 5
-        await db.user_xp.update_one(
-            {"user_id": request.user_id},
-            {"$set": {
-                "glossary_xp": new_glossary_xp,
-                "total_xp": new_total_xp,
-                "last_updated": datetime.utcnow()
-            }}
+        glossary_xp_seen.move_to_end(user_id)
+    return seen
+
+async def _glossary_claims(user_id: str, term_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    claims = await db.glossary_xp_awards.find(
+        {"user_id": user_id, "term_id": {"$in": term_ids}}, {"_id": 0, "term_id": 1, "event_id": 1, "applied": 1}
+    ).to_list(len(term_ids))
+    return {c["term_id"]: c for c in claims}
+
+def _unapplied_event_ids(claims: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+    """Event ids of claims whose award has not reached the ledger yet.
+
+    Claims written before awards were tracked have no applied field and
+    count as applied.
+    """
+    return {term_id: c["event_id"] for term_id, c in claims.items() if c.get("applied") is False}
+
+async def claim_glossary_terms(user_id: str, event_ids: Dict[str, str]) -> Dict[str, str]:
+    """Record first views of terms for user_id, each with the id of the ledger event awarding it.
+
+    Returns term id -> event id for every award still to apply: new claims,
+    plus earlier claims whose award never reached the ledger because the
+    request failed in between. Callers apply those events and then call
+    mark_glossary_claims_applied; the ledger skips event ids it already
+    holds, so retrying a claim never awards twice.
+    """
+    seen = _glossary_seen_filter(user_id)
+    term_ids = list(event_ids)
+    claimed: Dict[str, str] = {}
+    maybe_seen = [t for t in term_ids if t in seen]
+    if maybe_seen:
+        # Possible repeats: confirm with a read instead of attempting writes.
+        # Filter false positives have no claim and still go on to be inserted.
+        existing = await _glossary_claims(user_id, maybe_seen)
+        claimed.update(_unapplied_event_ids(existing))
+        term_ids = [t for t in term_ids if t not in existing]
+    if term_ids:
+        now = datetime.utcnow()
+        new = set(term_ids)
+        try:
+            await db.glossary_xp_awards.insert_many(
+                [
+                    {"user_id": user_id, "term_id": t, "awarded_at": now, "event_id": event_ids[t], "applied": False}
+                    for t in term_ids
+                ],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            # Claimed by another worker or before this process started
+            duplicates = [term_ids[i] for i in _duplicate_indexes(e)]
+            new -= set(duplicates)
+            claimed.update(_unapplied_event_ids(await _glossary_claims(user_id, duplicates)))
+        claimed.update({t: event_ids[t] for t in new})
+    for term_id in event_ids:
+        seen.add(term_id)
+    return claimed
+
+async def mark_glossary_claims_applied(user_id: str, term_ids: List[str]):
+    """Record that the awards for these claims are in the ledger"""
+    if term_ids:
+        await db.glossary_xp_awards.update_many(
+            {"user_id": user_id, "term_id": {"$in": term_ids}, "applied": False}, {"$set": {"applied": True}}
         )
-        return {"status": "success", "xp_earned": 5, "total_xp": new_total_xp}
+
+@api_router.post("/users/xp/glossary")
+async def award_glossary_xp(request: XPRequest):
+    """Award 5 XP the first time a user views a glossary term"""
+    if not request.term_id:
+        raise HTTPException(status_code=400, detail="term_id is required")
+    event = XPEvent(
+        user_id=request.user_id,
+        kind=XPEventKind.GLOSSARY_VIEW,
+        category="glossary_xp",
+        points=GLOSSARY_XP_POINTS,
+        ref_id=request.term_id
+    )
+    claimed = await claim_glossary_terms(request.user_id, {request.term_id: event.id})
+    if request.term_id not in claimed:
+        user_xp = await get_user_xp(request.user_id)
+        return {"status": "already_awarded", "xp_earned": 0, "total_xp": user_xp.total_xp}
+    # A retried claim reuses its recorded event id, so the ledger can skip it if it landed
+    event.id = claimed[request.term_id]
+    applied, user_xp = await apply_xp_events(request.user_id, [event])
+    await mark_glossary_claims_applied(request.user_id, [request.term_id])
+    if not applied:
+        return {"status": "already_awarded", "xp_earned": 0, "total_xp": user_xp["total_xp"]}
+    return {"status": "success", "xp_earned": GLOSSARY_XP_POINTS, "total_xp": user_xp["total_xp"]}
 
 @api_router.post("/users/xp/quiz")
 async def award_quiz_xp(request: XPRequest):
     """Award XP for quiz completion"""
     points = request.points or 10  # Default 10 points for quiz
-    user_xp = await db.user_xp.find_one({"user_id": request.user_id})
-    if not user_xp:
-        new_xp = UserXP(user_id=request.user_id, quiz_xp=points, total_xp=points)
-        await db.user_xp.insert_one(new_xp.dict())
-        return {"status": "success", "xp_earned": points, "total_xp": points}
-    else:
-        new_quiz_xp = user_xp["quiz_xp"] + points
-        new_total_xp = user_xp["total_xp"] + points
-        await db.user_xp.update_one(
-            {"user_id": request.user_id},
+    user_xp = await apply_xp_event(XPEvent(
+        user_id=request.user_id,
+        kind=XPEventKind.QUIZ_COMPLETION,
+        category="quiz_xp",
+        points=points
+    ))
+    return {"status": "success", "xp_earned": points, "total_xp": user_xp["total_xp"]}
+
+MAX_XP_EVENT_BATCH = 500
+
+class XPEventInput(BaseModel):
+    idempotency_key: str  # Generated by the client, unique per user
+    kind: XPEventKind
+    term_id: Optional[str] = None
+    points: Optional[int] = None
+
+class XPEventBatch(BaseModel):
+    user_id: str = "default_user"
+    events: List[XPEventInput]
+
+@api_router.post("/users/xp/events/batch")
+async def ingest_xp_events(batch: XPEventBatch):
+    """Apply an ordered batch of queued XP events, e.g. from a client syncing after being offline.
+
+    Replayed idempotency keys and glossary terms that already earned XP are
+    reported back instead of being applied again.
+    """
+    if len(batch.events) > MAX_XP_EVENT_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_XP_EVENT_BATCH} events per batch")
+    if any(e.kind == XPEventKind.OPENING_BALANCE for e in batch.events):
+        raise HTTPException(status_code=400, detail="Opening balance events cannot be submitted")
+    if any(e.kind == XPEventKind.GLOSSARY_VIEW and not e.term_id for e in batch.events):
+        raise HTTPException(status_code=400, detail="Glossary view events need a term_id")
+
+    results: Dict[str, str] = {}
+    inputs: List[XPEventInput] = []
+    for event in batch.events:
+        if event.idempotency_key in results:
+            continue
+        results[event.idempotency_key] = "duplicate"
+        inputs.append(event)
+
+    event_ids: Dict[str, str] = {}
+    for item in inputs:
+        if item.kind == XPEventKind.GLOSSARY_VIEW:
+            event_ids.setdefault(item.term_id, f"{batch.user_id}:{item.idempotency_key}")
+    claimed = await claim_glossary_terms(batch.user_id, event_ids) if event_ids else {}
+    claimed_terms = list(claimed)
+
+    now = datetime.utcnow()
+    events: List[XPEvent] = []
+    keys_by_event_id: Dict[str, str] = {}
+    for position, item in enumerate(inputs):
+        event_id = f"{batch.user_id}:{item.idempotency_key}"
+        if item.kind == XPEventKind.GLOSSARY_VIEW:
+            if item.term_id not in claimed:
+                results[item.idempotency_key] = "already_awarded"
+                continue
+            # Only the first view in the batch earns XP, under the id its claim recorded
+            event_id = claimed.pop(item.term_id)
+            category, points = "glossary_xp", GLOSSARY_XP_POINTS
+        else:
+            category, points = "quiz_xp", item.points or 10
+        events.append(XPEvent(
+            id=event_id,
+            user_id=batch.user_id,
+            kind=item.kind,
+            category=category,
+            points=points,
+            ref_id=item.term_id,
+            # Keep the client's ordering inside the ledger
+            created_at=now + timedelta(microseconds=position)
+        ))
+        keys_by_event_id[events[-1].id] = item.idempotency_key
+
+    applied, user_xp = await apply_xp_events(batch.user_id, events)
+    await mark_glossary_claims_applied(batch.user_id, claimed_terms)
+    for event in applied:
+        results[keys_by_event_id[event.id]] = "applied"
+    return {
+        "status": "success",
+        "xp_earned": sum(e.points for e in applied),
+        "total_xp": user_xp["total_xp"] if user_xp else 0,
+        "results": [{"idempotency_key": key, "status": status} for key, status in results.items()]
+    }
+
+@api_router.get("/users/xp/{user_id}/events")
+async def get_user_xp_events(user_id: str, before: Optional[datetime] = None, limit: int = 50):
+    """Page through a user's XP ledger, newest first"""
+    limit = max(1, min(limit, 200))
+    query: Dict[str, Any] = {"user_id": user_id}
+    if before:
+        query["created_at"] = {"$lt": before}
+    events = await db.xp_events.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    return {
+        "events": [XPEvent(**e) for e in events],
+        "next_before": events[-1]["created_at"] if len(events) == limit else None
+    }
+
+# XP ledger compaction
+# Points per event kind under the current rules; None keeps the points the
+# event was recorded with. Changing a value here and running a rebuild
+# recomputes every user's XP.
+XP_EVENT_RULES: Dict[XPEventKind, Optional[int]] = {
+    XPEventKind.GLOSSARY_VIEW: GLOSSARY_XP_POINTS,
+    XPEventKind.QUIZ_COMPLETION: None,
+    XPEventKind.OPENING_BALANCE: None,
+}
+# Snapshots touched this recently are left for the next run, so an award
+# that is between its ledger insert and snapshot $inc is never lost.
+XP_COMPACTION_GRACE_SECONDS = 60
+XP_COMPACTION_INTERVAL_SECONDS = int(os.environ.get("XP_COMPACTION_INTERVAL_SECONDS", "0"))
+
+async def seed_xp_opening_balances(batch_size: int = 1000) -> int:
+    """Give pre-ledger XP records opening balance events so replays keep their totals"""
+    seeded = 0
+    cursor = db.user_xp.find({"ledger_seeded": {"$ne": True}}, batch_size=batch_size)
+    async for user_xp in cursor:
+        user_id = user_xp["user_id"]
+        recorded = {"quiz_xp": 0, "glossary_xp": 0}
+        async for row in db.xp_events.aggregate([
+            {"$match": {"user_id": user_id}},
+            {"$group": {"_id": "$category", "points": {"$sum": "$points"}}}
+        ]):
+            recorded[row["_id"]] = row["points"]
+        opening_ids = []
+        for category in ("quiz_xp", "glossary_xp"):
+            points = user_xp.get(category, 0) - recorded.get(category, 0)
+            if points:
+                event = XPEvent(
+                    id=f"opening:{user_id}:{category}",
+                    user_id=user_id,
+                    kind=XPEventKind.OPENING_BALANCE,
+                    category=category,
+                    points=points,
+                    created_at=user_xp.get("created_at") or datetime.utcnow()
+                )
+                await db.xp_events.replace_one({"id": event.id}, event.dict(), upsert=True)
+                opening_ids.append(event.id)
+        result = await db.user_xp.update_one(
+            {"user_id": user_id, "last_updated": user_xp.get("last_updated")},
+            {"$set": {"ledger_seeded": True}}
+        )
+        if result.modified_count:
+            seeded += 1
+        elif opening_ids:
+            # An award landed meanwhile; retry this user on the next run
+            await db.xp_events.delete_many({"id": {"$in": opening_ids}})
+    return seeded
+
+async def rebuild_xp_snapshots(batch_size: int = 1000) -> Dict[str, int]:
+    """Replay the XP ledger into user_xp snapshots under the current XP_EVENT_RULES.
+
+    Users are folded server-side by an aggregation and streamed back in
+    batches, so memory stays bounded however many users there are. Weekly
+    leaderboard totals are not replayed.
+    """
+    seeded = await seed_xp_opening_balances(batch_size)
+    cutoff = datetime.utcnow() - timedelta(seconds=XP_COMPACTION_GRACE_SECONDS)
+    points = {"$switch": {
+        "branches": [
+            {"case": {"$eq": ["$kind", kind.value]}, "then": value}
+            for kind, value in XP_EVENT_RULES.items() if value is not None
+        ],
+        "default": "$points"
+    }}
+    cursor = db.xp_events.aggregate([
+        {"$match": {"created_at": {"$lt": cutoff}}},
+        {"$group": {
+            "_id": "$user_id",
+            "quiz_xp": {"$sum": {"$cond": [{"$eq": ["$category", "quiz_xp"]}, points, 0]}},
+            "glossary_xp": {"$sum": {"$cond": [{"$eq": ["$category", "glossary_xp"]}, points, 0]}}
+        }}
+    ], allowDiskUse=True, batchSize=batch_size)
+
+    stats = {"users": 0, "updated": 0, "seeded": seeded}
+    compacted_at = datetime.utcnow()
+    ops = []
+    async for row in cursor:
+        stats["users"] += 1
+        ops.append(UpdateOne(
+            {"user_id": row["_id"], "ledger_seeded": True, "last_updated": {"$lt": cutoff}},
             {"$set": {
-                "quiz_xp": new_quiz_xp,
-                "total_xp": new_total_xp,
-                "last_updated": datetime.utcnow()
+                "quiz_xp": row["quiz_xp"],
+                "glossary_xp": row["glossary_xp"],
+                "total_xp": row["quiz_xp"] + row["glossary_xp"],
+                "compacted_at": compacted_at
             }}
-        )
-        return {"status": "success", "xp_earned": points, "total_xp": new_total_xp}
+        ))
+        if len(ops) >= batch_size:
+            stats["updated"] += (await db.user_xp.bulk_write(ops, ordered=False)).modified_count
+            ops = []
+    if ops:
+        stats["updated"] += (await db.user_xp.bulk_write(ops, ordered=False)).modified_count
+    reset_leaderboards()
+    return stats
+
+async def compact_xp_ledger_periodically():
+    while True:
+        await asyncio.sleep(XP_COMPACTION_INTERVAL_SECONDS)
+        try:
+            stats = await rebuild_xp_snapshots()
+            logger.info(f"XP ledger compaction: {stats}")
+        except Exception:
+            logger.exception("XP ledger compaction failed")
+
+@api_router.post("/admin/xp/rebuild")
+async def rebuild_xp(batch_size: int = 1000):
+    return await rebuild_xp_snapshots(max(1, batch_size))
+
+# Leaderboard
+LEADERBOARD_CACHE_SIZE = 100
+LEADERBOARD_REFRESH_SECONDS = 60
+
+class TopKLeaderboard:
+    """In-memory top-K standings, updated from XP award events.
+
+    Scores only grow between reloads, so a user outside the top K can enter
+    only by beating the current minimum. Stale heap entries are skipped lazily.
+    """
+
+    def __init__(self, capacity: int = LEADERBOARD_CACHE_SIZE):
+        self.capacity = capacity
+        self.scores: Dict[str, int] = {}
+        self.heap: List[tuple] = []
+        self.loaded_at: Optional[datetime] = None
+
+    def load(self, rows: List[tuple]):
+        self.scores = dict(rows)
+        self.heap = [(score, user_id) for user_id, score in self.scores.items()]
+        heapq.heapify(self.heap)
+        self.loaded_at = datetime.utcnow()
+
+    def is_stale(self) -> bool:
+        # Awards handled by other workers only show up after a reload
+        return self.loaded_at is None or (datetime.utcnow() - self.loaded_at).total_seconds() > LEADERBOARD_REFRESH_SECONDS
+
+    def _min_score(self) -> int:
+        while self.heap and self.scores.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+    def update(self, user_id: str, score: int):
+        if self.loaded_at is None:
+            return
+        if user_id not in self.scores and len(self.scores) >= self.capacity:
+            if score <= self._min_score():
+                return
+            _, evicted = heapq.heappop(self.heap)
+            del self.scores[evicted]
+        self.scores[user_id] = score
+        heapq.heappush(self.heap, (score, user_id))
+        if len(self.heap) > 4 * self.capacity:
+            self.load(list(self.scores.items()))
+
+    def top(self, limit: int) -> List[tuple]:
+        return heapq.nsmallest(limit, self.scores.items(), key=lambda item: (-item[1], item[0]))
+
+global_leaderboard = TopKLeaderboard()
+weekly_leaderboards: Dict[str, TopKLeaderboard] = {}
+
+def current_xp_week(now: Optional[datetime] = None) -> str:
+    year, week, _ = (now or datetime.utcnow()).isocalendar()
+    return f"{year}-W{week:02d}"
+
+def get_weekly_leaderboard(week: str) -> TopKLeaderboard:
+    board = weekly_leaderboards.get(week)
+    if board is None:
+        # Only the current week receives awards, so older boards can go
+        weekly_leaderboards.clear()
+        board = weekly_leaderboards[week] = TopKLeaderboard()
+    return board
+
+def reset_leaderboards():
+    global_leaderboard.loaded_at = None
+    weekly_leaderboards.clear()
+
+async def record_xp_award(user_id: str, points: int, total_xp: int):
+    """Fold an XP award into the weekly totals and the cached standings"""
+    week = current_xp_week()
+    weekly = await db.user_xp_weekly.find_one_and_update(
+        {"week": week, "user_id": user_id},
+        {"$inc": {"xp": points}, "$set": {"last_updated": datetime.utcnow()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    global_leaderboard.update(user_id, total_xp)
+    get_weekly_leaderboard(week).update(user_id, weekly["xp"])
+
+def _leaderboard_entries(rows: List[tuple]) -> List[Dict[str, Any]]:
+    # Tied users share a rank
+    entries = []
+    for index, (user_id, xp) in enumerate(rows):
+        rank = entries[-1]["rank"] if entries and entries[-1]["xp"] == xp else index + 1
+        entries.append({"rank": rank, "user_id": user_id, "xp": xp})
+    return entries
+
+@api_router.get("/leaderboard")
+async def get_leaderboard(limit: int = 10):
+    limit = max(1, min(limit, LEADERBOARD_CACHE_SIZE))
+    if global_leaderboard.is_stale():
+        top_users = await db.user_xp.find({}, {"_id": 0, "user_id": 1, "total_xp": 1}) \
+            .sort("total_xp", -1).limit(global_leaderboard.capacity).to_list(global_leaderboard.capacity)
+        global_leaderboard.load([(u["user_id"], u["total_xp"]) for u in top_users])
+    return _leaderboard_entries(global_leaderboard.top(limit))
+
+@api_router.get("/leaderboard/weekly")
+async def get_weekly_leaderboard_standings(limit: int = 10):
+    limit = max(1, min(limit, LEADERBOARD_CACHE_SIZE))
+    week = current_xp_week()
+    board = get_weekly_leaderboard(week)
+    if board.is_stale():
+        top_users = await db.user_xp_weekly.find({"week": week}, {"_id": 0, "user_id": 1, "xp": 1}) \
+            .sort("xp", -1).limit(board.capacity).to_list(board.capacity)
+        board.load([(u["user_id"], u["xp"]) for u in top_users])
+    return {"week": week, "entries": _leaderboard_entries(board.top(limit))}
+
+@api_router.get("/leaderboard/rank/{user_id}")
+async def get_leaderboard_rank(user_id: str):
+    """Rank = 1 + users strictly ahead, counted on the XP indexes"""
+    week = current_xp_week()
+    user_xp = await db.user_xp.find_one({"user_id": user_id}, {"_id": 0, "total_xp": 1})
+    weekly = await db.user_xp_weekly.find_one({"week": week, "user_id": user_id}, {"_id": 0, "xp": 1})
+    total_xp = user_xp["total_xp"] if user_xp else 0
+    weekly_xp = weekly["xp"] if weekly else 0
+    return {
+        "user_id": user_id,
+        "total_xp": total_xp,
+        "rank": await db.user_xp.count_documents({"total_xp": {"$gt": total_xp}}) + 1,
+        "week": week,
+        "weekly_xp": weekly_xp,
+        "weekly_rank": await db.user_xp_weekly.count_documents({"week": week, "xp": {"$gt": weekly_xp}}) + 1
+    }
 
 # Marketplace endpoints
 @api_router.get("/marketplace", response_model=List[MarketplaceItem])
@@ -305,17 +829,281 @@ async def get_marketplace_item(item_id: str):
     return MarketplaceItem(**item)
 
 # User progress endpoints
+# One document per (user_id, course_id, lesson_id), enforced by a unique index.
+PROGRESS_KEY_FIELDS = ("user_id", "course_id", "lesson_id")
+
+async def upsert_user_progress(progress: UserProgress):
+    """Create or update the progress document for one lesson in a single round trip"""
+    fields = progress.dict()
+    progress_id = fields.pop("id")
+    key = {field: fields.pop(field) for field in PROGRESS_KEY_FIELDS}
+    fields["updated_at"] = datetime.utcnow()
+    previous = await db.user_progress.find_one_and_update(
+        key,
+        {"$set": fields, "$setOnInsert": {"id": progress_id}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    previous = previous or {}
+    await apply_course_summary_delta(
+        progress.user_id,
+        progress.course_id,
+        completed_delta=int(progress.completed) - int(bool(previous.get("completed"))),
+        score_delta=(progress.score or 0) - (previous.get("score") or 0)
+    )
+
+MAX_PROGRESS_SYNC_BATCH = 500
+
+class ProgressChange(BaseModel):
+    course_id: str
+    lesson_id: str
+    completed: bool = False
+    score: Optional[int] = None
+    completed_at: Optional[datetime] = None
+    client_timestamp: datetime  # When the change happened on the client
+
+class ProgressSyncRequest(BaseModel):
+    changes: List[ProgressChange] = []
+    xp_events: List[XPEventInput] = []
+
+@api_router.post("/users/{user_id}/progress/sync")
+async def sync_user_progress(user_id: str, sync: ProgressSyncRequest):
+    """Apply a batch of lesson state changes, last writer wins per lesson.
+
+    Each lesson's stored updated_at is compared against the change's
+    client_timestamp inside the update itself, so a stale change is a no-op
+    even when another request wins the race. Queued XP events can ride
+    along and go through the XP batch ingestion path.
+    """
+    if len(sync.changes) > MAX_PROGRESS_SYNC_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PROGRESS_SYNC_BATCH} changes per sync")
+
+    latest: Dict[tuple, ProgressChange] = {}
+    for change in sync.changes:
+        # Compare as naive UTC at the millisecond precision Mongo stores
+        ts = change.client_timestamp
+        if ts.tzinfo:
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        change.client_timestamp = ts.replace(microsecond=ts.microsecond // 1000 * 1000)
+        key = (change.course_id, change.lesson_id)
+        if key not in latest or change.client_timestamp > latest[key].client_timestamp:
+            latest[key] = change
+
+    lessons = []
+    if latest:
+        ops = []
+        for change in latest.values():
+            newer = {"$gt": [change.client_timestamp, {"$ifNull": ["$updated_at", datetime(1970, 1, 1)]}]}
+            ops.append(UpdateOne(
+                {"user_id": user_id, "course_id": change.course_id, "lesson_id": change.lesson_id},
+                [{"$set": {
+                    "id": {"$ifNull": ["$id", str(uuid.uuid4())]},
+                    "completed": {"$cond": [newer, change.completed, "$completed"]},
+                    "score": {"$cond": [newer, change.score, "$score"]},
+                    "completed_at": {"$cond": [newer, change.completed_at, "$completed_at"]},
+                    "updated_at": {"$cond": [newer, change.client_timestamp, "$updated_at"]}
+                }}],
+                upsert=True
+            ))
+        await db.user_progress.bulk_write(ops, ordered=False)
+
+        course_ids = list({course_id for course_id, _ in latest})
+        await refresh_course_summaries({"user_id": user_id, "course_id": {"$in": course_ids}})
+        lessons = await db.user_progress.find({
+            "user_id": user_id,
+            "$or": [{"course_id": c, "lesson_id": l} for c, l in latest]
+        }).to_list(len(latest))
+
+    applied = sum(
+        1 for lesson in lessons
+        if lesson.get("updated_at") == latest[(lesson["course_id"], lesson["lesson_id"])].client_timestamp
+    )
+    response = {
+        "status": "success",
+        "applied": applied,
+        "stale": len(latest) - applied,
+        "lessons": [UserProgress(**lesson) for lesson in lessons]
+    }
+    if sync.xp_events:
+        response["xp"] = await ingest_xp_events(XPEventBatch(user_id=user_id, events=sync.xp_events))
+    return response
+
+# Per-user, per-course completion summaries, maintained incrementally from
+# the before/after state of each progress write so the dashboard reads one
+# small document per course.
+course_lesson_counts: Dict[str, int] = {}
+
+async def get_course_lesson_count(course_id: str) -> int:
+    if course_id not in course_lesson_counts:
+        course = await db.courses.find_one({"id": course_id}, {"_id": 0, "total_lessons": 1})
+        course_lesson_counts[course_id] = course["total_lessons"] if course else 0
+    return course_lesson_counts[course_id]
+
+def _completion_percentage_stage() -> Dict[str, Any]:
+    return {"$set": {"completion_percentage": {"$cond": [
+        {"$gt": ["$total_lessons", 0]},
+        {"$min": [100, {"$round": [{"$multiply": [{"$divide": ["$completed_lessons", "$total_lessons"]}, 100]}, 1]}]},
+        0
+    ]}}}
+
+async def apply_course_summary_delta(user_id: str, course_id: str, completed_delta: int, score_delta: int):
+    result = await db.course_progress_summaries.update_one(
+        {"user_id": user_id, "course_id": course_id},
+        [
+            {"$set": {
+                "completed_lessons": {"$add": [{"$ifNull": ["$completed_lessons", 0]}, completed_delta]},
+                "total_score": {"$add": [{"$ifNull": ["$total_score", 0]}, score_delta]},
+                "total_lessons": await get_course_lesson_count(course_id),
+                "last_activity": datetime.utcnow()
+            }},
+            _completion_percentage_stage()
+        ],
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        # No summary existed, so the delta alone undercounts earlier progress
+        await refresh_course_summaries({"user_id": user_id, "course_id": course_id})
+
+async def refresh_course_summaries(query: Dict[str, Any], batch_size: int = 1000) -> int:
+    """Recompute summaries from raw progress rows matching query"""
+    ops = []
+    refreshed = 0
+    async for row in db.user_progress.aggregate([
+        {"$match": query},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "course_id": "$course_id"},
+            "completed_lessons": {"$sum": {"$cond": ["$completed", 1, 0]}},
+            "total_score": {"$sum": {"$ifNull": ["$score", 0]}},
+            "last_activity": {"$max": "$completed_at"}
+        }}
+    ], allowDiskUse=True, batchSize=batch_size):
+        ops.append(UpdateOne(
+            row["_id"],
+            [
+                {"$set": {
+                    "completed_lessons": row["completed_lessons"],
+                    "total_score": row["total_score"],
+                    "total_lessons": await get_course_lesson_count(row["_id"]["course_id"]),
+                    "last_activity": {"$max": ["$last_activity", row["last_activity"]]}
+                }},
+                _completion_percentage_stage()
+            ],
+            upsert=True
+        ))
+        if len(ops) >= batch_size:
+            refreshed += len(ops)
+            await db.course_progress_summaries.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        refreshed += len(ops)
+        await db.course_progress_summaries.bulk_write(ops, ordered=False)
+    return refreshed
+
+async def backfill_course_summaries(batch_size: int = 1000) -> int:
+    """Build summaries for (user, course) pairs with progress rows but no summary yet"""
+    pairs = []
+    backfilled = 0
+    async for row in db.user_progress.aggregate([
+        {"$group": {"_id": {"user_id": "$user_id", "course_id": "$course_id"}}},
+        {"$lookup": {
+            "from": "course_progress_summaries",
+            "let": {"user_id": "$_id.user_id", "course_id": "$_id.course_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$user_id", "$$user_id"]}, {"$eq": ["$course_id", "$$course_id"]}
+                ]}}},
+                {"$project": {"_id": 1}},
+                {"$limit": 1}
+            ],
+            "as": "summary"
+        }},
+        {"$match": {"summary": {"$size": 0}}}
+    ], allowDiskUse=True, batchSize=batch_size):
+        pairs.append(row["_id"])
+        if len(pairs) >= batch_size:
+            backfilled += await refresh_course_summaries({"$or": pairs}, batch_size)
+            pairs = []
+    if pairs:
+        backfilled += await refresh_course_summaries({"$or": pairs}, batch_size)
+    return backfilled
+
+@api_router.get("/users/{user_id}/course-summaries", response_model=List[CourseProgressSummary])
+async def get_course_summaries(user_id: str):
+    summaries = await db.course_progress_summaries.find({"user_id": user_id}).to_list(100)
+    return [CourseProgressSummary(**summary) for summary in summaries]
+
+@api_router.get("/users/{user_id}/course-summaries/{course_id}", response_model=CourseProgressSummary)
+async def get_course_summary(user_id: str, course_id: str):
+    summary = await db.course_progress_summaries.find_one({"user_id": user_id, "course_id": course_id})
+    if not summary:
+        return CourseProgressSummary(
+            user_id=user_id,
+            course_id=course_id,
+            total_lessons=await get_course_lesson_count(course_id)
+        )
+    return CourseProgressSummary(**summary)
+
+@api_router.post("/admin/progress/summaries/rebuild")
+async def rebuild_course_summaries():
+    return {"refreshed": await refresh_course_summaries({})}
+
 @api_router.get("/users/{user_id}/progress")
+@api_router.get("/progress/{user_id}")
 async def get_user_progress(user_id: str):
     progress = await db.user_progress.find({"user_id": user_id}).to_list(1000)
     return [UserProgress(**p) for p in progress]
 
 @api_router.post("/users/{user_id}/progress")
 async def update_user_progress(user_id: str, progress: UserProgress):
-    await db.user_progress.insert_one(progress.dict())
+    progress.user_id = user_id
+    await upsert_user_progress(progress)
     return {"status": "Progress updated"}
 
+@api_router.post("/progress")
+async def update_progress(progress: UserProgress):
+    await upsert_user_progress(progress)
+    return {"status": "success"}
+
 # Chat endpoints
+# Messages live in chat_messages, one document each, indexed by
+# (thread_id, timestamp). Thread documents keep only a bounded window of
+# recent messages so they stay small however long the conversation runs.
+THREAD_RECENT_MESSAGES = 20
+MAX_MESSAGE_PAGE = 100
+# Sidebar fields only, for listings that do not need message bodies
+THREAD_SUMMARY_PROJECTION = {
+    "_id": 0, "id": 1, "title": 1, "summary": 1, "is_starred": 1, "created_at": 1, "last_updated": 1
+}
+# Every THREAD_SUMMARY_EVERY messages the new ones are folded into the
+# thread's rolling summary. They are read from the recent window, so this
+# must not exceed THREAD_RECENT_MESSAGES.
+THREAD_SUMMARY_EVERY = 10
+THREAD_SUMMARY_TOPICS = 8
+THREAD_SUMMARY_QUESTIONS = 5
+THREAD_CONTEXT_MESSAGES = 6  # Latest exchanges passed to QGPT alongside the summary
+
+def encode_cursor(timestamp: datetime, item_id: str) -> str:
+    raw = f"{timestamp.isoformat()}|{item_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        timestamp, item_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+        return datetime.fromisoformat(timestamp), item_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_before(cursor: str, time_field: str) -> Dict[str, Any]:
+    """Filter for items strictly after cursor in (time_field, id) descending order"""
+    timestamp, item_id = decode_cursor(cursor)
+    return {"$or": [
+        {time_field: {"$lt": timestamp}},
+        {time_field: timestamp, "id": {"$lt": item_id}}
+    ]}
+
+async def store_chat_messages(thread_id: str, messages: List[ChatMessage]):
+    await db.chat_messages.insert_many([{**m.dict(), "thread_id": thread_id} for m in messages])
+
 @api_router.get("/users/{user_id}/chat-threads")
 async def get_chat_threads(user_id: str):
     threads = await db.chat_threads.find({"user_id": user_id}).sort("last_updated", -1).to_list(1000)
@@ -324,9 +1112,106 @@ async def get_chat_threads(user_id: str):
 @api_router.post("/users/{user_id}/chat-threads")
 async def create_chat_thread(user_id: str, thread: ChatThread):
     thread.user_id = user_id
+    # Embedded messages belong to the path user too, whatever the body claimed
+    for m in thread.messages:
+        m.user_id = user_id
+    if thread.messages:
+        await store_chat_messages(thread.id, thread.messages)
+    thread.message_count = len(thread.messages)
+    thread.messages = thread.messages[-THREAD_RECENT_MESSAGES:]
     await db.chat_threads.insert_one(thread.dict())
     return thread
 
+MAX_THREAD_PAGE = 100
+THREAD_PREVIEW_CHARS = 120
+
+# Declared before /chat-threads/{thread_id} so the path is not shadowed
+@api_router.get("/users/{user_id}/chat-threads/list")
+async def list_chat_threads(user_id: str, before: Optional[str] = None, limit: int = 30):
+    """Sidebar listing: thread metadata and a preview of the latest message, newest first"""
+    limit = max(1, min(limit, MAX_THREAD_PAGE))
+    query: Dict[str, Any] = {"user_id": user_id}
+    if before:
+        query.update(keyset_before(before, "last_updated"))
+    projection = {**THREAD_SUMMARY_PROJECTION, "message_count": 1, "messages": {"$slice": -1}}
+    threads = await db.chat_threads.find(query, projection) \
+        .sort([("last_updated", -1), ("id", -1)]).limit(limit).to_list(limit)
+    items = []
+    for thread in threads:
+        latest = thread.pop("messages", [])
+        thread["last_message_preview"] = latest[-1]["message"][:THREAD_PREVIEW_CHARS] if latest else None
+        items.append(thread)
+    return {
+        "threads": items,
+        "next_cursor": encode_cursor(threads[-1]["last_updated"], threads[-1]["id"]) if len(threads) == limit else None
+    }
+
+SEARCH_SNIPPET_RADIUS = 60
+MAX_SEARCH_PAGE = 50
+
+def highlight_snippet(text: str, terms: List[str]) -> Optional[str]:
+    """Excerpt around the first match of any term, with matches wrapped in **"""
+    if not text or not terms:
+        return None
+    text = text.replace("**", "")
+    # Prefix match roughly mirrors the text index's stemming ("qualify" -> "qualifying")
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(t) for t in terms) + r")\w*", re.IGNORECASE)
+    first = pattern.search(text)
+    if not first:
+        return None
+    start = max(0, first.start() - SEARCH_SNIPPET_RADIUS)
+    end = min(len(text), first.end() + SEARCH_SNIPPET_RADIUS)
+    snippet = pattern.sub(lambda m: f"**{m.group(0)}**", text[start:end])
+    return ("…" if start else "") + snippet + ("…" if end < len(text) else "")
+
+# Declared before /chat-threads/{thread_id} so the path is not shadowed
+@api_router.get("/users/{user_id}/chat-threads/search")
+async def search_chat_messages(user_id: str, query: str, page: int = 1, limit: int = 20):
+    """Message-level search over a user's chat history, best matches first.
+
+    Backed by a text index on chat_messages prefixed with user_id, so only
+    the caller's messages are ever examined.
+    """
+    terms = re.findall(r"\w+", query.lower())
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query must contain a word")
+    limit = max(1, min(limit, MAX_SEARCH_PAGE))
+    page = max(1, page)
+    hits = await db.chat_messages.find(
+        {"user_id": user_id, "$text": {"$search": query}},
+        {"_id": 0, "id": 1, "thread_id": 1, "message": 1, "response": 1, "timestamp": 1,
+         "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"}), ("timestamp", -1)]) \
+        .skip((page - 1) * limit).limit(limit + 1).to_list(limit + 1)
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    thread_ids = list({hit["thread_id"] for hit in hits})
+    titles = {
+        t["id"]: t["title"]
+        for t in await db.chat_threads.find(
+            {"user_id": user_id, "id": {"$in": thread_ids}}, {"_id": 0, "id": 1, "title": 1}
+        ).to_list(len(thread_ids))
+    }
+    results = [{
+        "thread_id": hit["thread_id"],
+        "thread_title": titles.get(hit["thread_id"]),
+        "message_id": hit["id"],
+        "timestamp": hit["timestamp"],
+        "score": hit["score"],
+        "message_snippet": highlight_snippet(hit["message"], terms),
+        "response_snippet": highlight_snippet(hit["response"], terms)
+    } for hit in hits]
+
+    response: Dict[str, Any] = {"query": query, "page": page, "has_more": has_more, "results": results}
+    if page == 1:
+        title_pattern = "|".join(re.escape(t) for t in terms)
+        response["threads"] = await db.chat_threads.find(
+            {"user_id": user_id, "title": {"$regex": title_pattern, "$options": "i"}},
+            THREAD_SUMMARY_PROJECTION
+        ).sort([("last_updated", -1), ("id", -1)]).limit(10).to_list(10)
+    return response
+
 @api_router.get("/users/{user_id}/chat-threads/{thread_id}")
 async def get_chat_thread(user_id: str, thread_id: str):
     thread = await db.chat_threads.find_one({"id": thread_id, "user_id": user_id})
@@ -334,55 +1219,517 @@ async def get_chat_thread(user_id: str, thread_id: str):
         raise HTTPException(status_code=404, detail="Chat thread not found")
     return ChatThread(**thread)
 
+@api_router.get("/users/{user_id}/chat-threads/{thread_id}/messages")
+async def get_chat_messages(user_id: str, thread_id: str, before: Optional[str] = None, limit: int = 50):
+    """Page backwards through a thread's history; pass next_cursor as before for older messages"""
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE))
+    query: Dict[str, Any] = {"thread_id": thread_id, "user_id": user_id}
+    if before:
+        query.update(keyset_before(before, "timestamp"))
+    page = await db.chat_messages.find(query, {"_id": 0, "thread_id": 0}) \
+        .sort([("timestamp", -1), ("id", -1)]).limit(limit).to_list(limit)
+    if not page and not before and not await db.chat_threads.find_one({"id": thread_id, "user_id": user_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Chat thread not found")
+    return {
+        # Oldest first within the page, ready to render
+        "messages": [ChatMessage(**m) for m in reversed(page)],
+        "next_cursor": encode_cursor(page[-1]["timestamp"], page[-1]["id"]) if len(page) == limit else None
+    }
+
+def fold_thread_summary(thread: Dict[str, Any], messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summary fields after adding `messages` to what the thread summary already covers"""
+    counts = {entry["topic"]: entry["count"] for entry in thread.get("summary_topics", [])}
+    questions = list(thread.get("summary_questions", []))
+    for message in messages:
+        topics = message.get("context_glossary", []) + [lesson["title"] for lesson in message.get("context_lessons", [])]
+        for topic in dict.fromkeys(topics):
+            counts[topic] = counts.get(topic, 0) + 1
+        questions.append(" ".join(message["message"].split())[:120])
+    topics = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:THREAD_SUMMARY_TOPICS]
+    questions = questions[-THREAD_SUMMARY_QUESTIONS:]
+    parts = []
+    if topics:
+        parts.append("Discussed: " + ", ".join(f"{topic} ({count})" for topic, count in topics) + ".")
+    if questions:
+        parts.append("Earlier questions: " + "; ".join(f'"{question}"' for question in questions) + ".")
+    return {
+        "summary": " ".join(parts),
+        "summary_topics": [{"topic": topic, "count": count} for topic, count in topics],
+        "summary_questions": questions
+    }
+
+async def update_thread_summary(user_id: str, thread: Dict[str, Any]):
+    """Fold messages added since the last summary, once THREAD_SUMMARY_EVERY have built up"""
+    summarized = thread.get("summarized_count", 0)
+    unsummarized = thread["message_count"] - summarized
+    if unsummarized < THREAD_SUMMARY_EVERY:
+        return
+    # Threads from before summaries existed fold only what is still in the window
+    window = thread.get("messages", [])
+    fields = fold_thread_summary(thread, window[-unsummarized:])
+    # Conditional on summarized_count, so a concurrent fold of the same messages wins once
+    await db.chat_threads.update_one(
+        {"id": thread["id"], "user_id": user_id, "summarized_count": {"$in": [summarized, None]}},
+        {"$set": {**fields, "summarized_count": thread["message_count"]}}
+    )
+
+async def save_chat_message(user_id: str, thread_id: str, message: ChatMessage) -> bool:
+    """Append a finished message to its thread; False if the thread does not exist.
+
+    The message is stored before the thread is touched, so a message id the
+    thread already has is rejected with 409 and leaves the thread as it was.
+    """
+    try:
+        await db.chat_messages.insert_one({**message.dict(), "thread_id": thread_id})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="A message with this id already exists in the thread")
+    thread = await db.chat_threads.find_one_and_update(
+        {"id": thread_id, "user_id": user_id},
+        {
+            "$push": {"messages": {"$each": [message.dict()], "$slice": -THREAD_RECENT_MESSAGES}},
+            "$inc": {"message_count": 1},
+            "$set": {"last_updated": datetime.utcnow()}
+        },
+        projection={
+            "_id": 0, "id": 1, "message_count": 1, "messages": 1,
+            "summarized_count": 1, "summary_topics": 1, "summary_questions": 1
+        },
+        return_document=ReturnDocument.AFTER
+    )
+    if thread is None:
+        await db.chat_messages.delete_one({"thread_id": thread_id, "id": message.id})
+        return False
+    await update_thread_summary(user_id, thread)
+    if similarity_index.ready:
+        similarity_index.append([question_document({**message.dict(), "thread_id": thread_id})])
+        if len(similarity_index.pending_rows) >= SIMILARITY_FLUSH_ROWS:
+            schedule_similarity_flush()
+    await chat_connections.broadcast(user_id, {"type": "thread_updated", "thread_id": thread_id, "message": message.dict()})
+    return True
+
 @api_router.post("/users/{user_id}/chat-threads/{thread_id}/messages")
 async def add_chat_message(user_id: str, thread_id: str, message: ChatMessage):
     # Simulate AI response with contextual links
-    ai_response = await generate_ai_response(message.message, user_id)
+    ai_response = await generate_ai_response(message.message, user_id, thread_id)
     
     message.user_id = user_id
     message.response = ai_response["response"]
     message.context_modules = ai_response.get("modules", [])
     message.context_glossary = ai_response.get("glossary", [])
+    message.context_lessons = ai_response.get("lessons", [])
+    message.context_passages = ai_response.get("passages", [])
     
     # Add message to thread
-    await db.chat_threads.update_one(
-        {"id": thread_id, "user_id": user_id},
-        {
-            "$push": {"messages": message.dict()},
-            "$set": {"last_updated": datetime.utcnow()}
-        }
-    )
+    if not await save_chat_message(user_id, thread_id, message):
+        raise HTTPException(status_code=404, detail="Chat thread not found")
     return message
 
-@api_router.put("/users/{user_id}/chat-threads/{thread_id}/messages/{message_id}/star")
-async def toggle_message_star(user_id: str, thread_id: str, message_id: str):
-    result = await db.chat_threads.update_one(
+def sse_event(event: str, data: Any) -> str:
+    payload = data if isinstance(data, str) else json.dumps(data, default=str)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+@api_router.post("/users/{user_id}/chat-threads/{thread_id}/messages/stream")
+async def stream_chat_message(user_id: str, thread_id: str, message: ChatMessage):
+    """Server-Sent Events variant of add_chat_message.
+
+    Emits a "context" event with the linked modules and glossary terms, then
+    "chunk" events as the response is produced, and finally a "done" event
+    with the stored message once it has been saved to the thread.
+    """
+    context = await build_ai_context(message.message, user_id, thread_id)
+    if context["conversation"] is None:
+        raise HTTPException(status_code=404, detail="Chat thread not found")
+    message.user_id = user_id
+    message.context_modules = context["modules"]
+    message.context_glossary = context["terms"]
+    message.context_lessons = context["lessons"]
+    message.context_passages = context["passages"]
+
+    async def events():
+        yield sse_event("context", {
+            "modules": message.context_modules,
+            "glossary": message.context_glossary,
+            "lessons": message.context_lessons,
+            "passages": message.context_passages,
+            "locked_content": not context["has_full_access"]
+        })
+        chunks = []
+        try:
+            async for chunk in stream_ai_response(message.message, context):
+                chunks.append(chunk)
+                yield sse_event("chunk", {"text": chunk})
+        except HTTPException as e:
+            # Headers are already sent, so backpressure is reported in-band
+            yield sse_event("error", {"detail": e.detail, "status_code": e.status_code})
+            return
+        except Exception:
+            logger.exception("QGPT streaming failed")
+            yield sse_event("error", {"detail": QGPT_GENERATION_FAILED, "status_code": 500})
+            return
+        message.response = "".join(chunks)
+        try:
+            saved = await save_chat_message(user_id, thread_id, message)
+        except HTTPException as e:
+            yield sse_event("error", {"detail": e.detail, "status_code": e.status_code})
+            return
+        if saved:
+            yield sse_event("done", message.json())
+        else:
+            yield sse_event("error", {"detail": "Chat thread not found", "status_code": 404})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Disable proxy buffering so chunks reach the client as they are sent
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Starred messages are also copied to starred_messages, indexed by
+# (user_id, starred_at), so the saved-answers view is one indexed read.
+STARRED_COPY_FIELDS = ("thread_id", "message", "response", "timestamp", "context_modules", "context_glossary")
+# Rounds of re-syncing the starred index when concurrent stars race; each round is one re-read
+STAR_SYNC_ATTEMPTS = 5
+
+async def _sync_starred_copies(user_id: str, thread_id: str, message: Dict[str, Any], starred: bool):
+    """Write the starred index entry and the recent-window flag for one star state"""
+    message_id = message["id"]
+    await db.chat_threads.update_one(
         {"id": thread_id, "user_id": user_id, "messages.id": message_id},
-        {"$set": {"messages.$.is_starred": True}}
+        {"$set": {"messages.$.is_starred": starred}}
+    )
+    if starred:
+        await db.starred_messages.update_one(
+            {"user_id": user_id, "id": message_id},
+            {"$setOnInsert": {
+                "starred_at": datetime.utcnow(), **{field: message.get(field) for field in STARRED_COPY_FIELDS}
+            }},
+            upsert=True
+        )
+    else:
+        await db.starred_messages.delete_one({"user_id": user_id, "id": message_id})
+
+async def star_chat_message(user_id: str, thread_id: str, message_id: str, starred: Optional[bool] = None) -> Optional[bool]:
+    """Set or, when starred is None, flip a message's star; returns the new state, or None if there is no such message"""
+    if starred is None:
+        update: Any = [{"$set": {"is_starred": {"$not": [{"$ifNull": ["$is_starred", False]}]}}}]
+    else:
+        update = {"$set": {"is_starred": starred}}
+    key = {"thread_id": thread_id, "user_id": user_id, "id": message_id}
+    message = await db.chat_messages.find_one_and_update(
+        key, update,
+        projection={"_id": 0, "id": 1, "is_starred": 1, **{field: 1 for field in STARRED_COPY_FIELDS}},
+        return_document=ReturnDocument.AFTER
     )
-    return {"status": "Message starred"}
+    if message is None:
+        return None
+    starred = message["is_starred"]
+    # A concurrent star may land between the flip and the copies; re-read
+    # after writing them until they match the stored state, so the last
+    # writer always leaves the index in step with chat_messages
+    for _ in range(STAR_SYNC_ATTEMPTS):
+        await _sync_starred_copies(user_id, thread_id, message, starred)
+        current = await db.chat_messages.find_one(key, {"_id": 0, "is_starred": 1})
+        if current is None or bool(current.get("is_starred")) == starred:
+            break
+        starred = bool(current.get("is_starred"))
+    await chat_connections.broadcast(user_id, {
+        "type": "message_starred", "thread_id": thread_id, "message_id": message_id, "is_starred": starred
+    })
+    return starred
 
-@api_router.get("/users/{user_id}/chat-threads/search")
-async def search_chat_messages(user_id: str, query: str):
-    threads = await db.chat_threads.find({
-        "user_id": user_id,
-        "$or": [
-            {"title": {"$regex": query, "$options": "i"}},
-            {"messages.message": {"$regex": query, "$options": "i"}},
-            {"messages.response": {"$regex": query, "$options": "i"}}
-        ]
-    }).to_list(1000)
-    return [ChatThread(**thread) for thread in threads]
+@api_router.put("/users/{user_id}/chat-threads/{thread_id}/messages/{message_id}/star")
+async def toggle_message_star(user_id: str, thread_id: str, message_id: str, starred: Optional[bool] = None):
+    """Flip the star, or set it explicitly with ?starred=true|false"""
+    is_starred = await star_chat_message(user_id, thread_id, message_id, starred)
+    if is_starred is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return {"status": "Message starred" if is_starred else "Message unstarred", "is_starred": is_starred}
+
+@api_router.get("/users/{user_id}/starred-messages")
+async def get_starred_messages(user_id: str, before: Optional[str] = None, limit: int = 50):
+    """Most recently starred first; pass next_cursor as before for the next page"""
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE))
+    query: Dict[str, Any] = {"user_id": user_id}
+    if before:
+        query.update(keyset_before(before, "starred_at"))
+    page = await db.starred_messages.find(query, {"_id": 0, "user_id": 0}) \
+        .sort([("starred_at", -1), ("id", -1)]).limit(limit).to_list(limit)
+    return {
+        "messages": page,
+        "next_cursor": encode_cursor(page[-1]["starred_at"], page[-1]["id"]) if len(page) == limit else None
+    }
+
+async def backfill_starred_messages():
+    """Index messages starred before starred_messages existed; existing entries are left alone"""
+    await db.chat_messages.aggregate([
+        {"$match": {"is_starred": True}},
+        {"$project": {
+            "_id": 0, "user_id": 1, "id": 1, "starred_at": "$timestamp", **{field: 1 for field in STARRED_COPY_FIELDS}
+        }},
+        {"$merge": {
+            "into": "starred_messages", "on": ["user_id", "id"], "whenMatched": "keepExisting", "whenNotMatched": "insert"
+        }}
+    ]).to_list(None)
+
+# Chat history export
+# Threads and their messages are read through cursors and written out in
+# chunks as they arrive, so memory stays flat however long the history is.
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_CSV_COLUMNS = ["thread_id", "thread_title", "message_id", "timestamp", "is_starred", "message", "response"]
+
+def export_value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+async def export_chat_records(user_id: str):
+    """("thread", thread) and ("message", message) pairs, each thread followed by its messages oldest first"""
+    threads = db.chat_threads.find(
+        {"user_id": user_id}, {**THREAD_SUMMARY_PROJECTION, "message_count": 1}, batch_size=EXPORT_BATCH_SIZE
+    ).sort([("last_updated", -1), ("id", -1)])
+    async for thread in threads:
+        yield "thread", thread
+        messages = db.chat_messages.find(
+            {"thread_id": thread["id"], "user_id": user_id}, {"_id": 0, "user_id": 0}, batch_size=EXPORT_BATCH_SIZE
+        ).sort([("timestamp", 1), ("id", 1)])
+        async for message in messages:
+            yield "message", message
+
+async def export_ndjson(user_id: str):
+    buffer = []
+    size = 0
+    async for kind, record in export_chat_records(user_id):
+        line = json.dumps({"type": kind, **record}, default=export_value) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+async def export_csv(user_id: str):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_CSV_COLUMNS)
+    title = ""
+    async for kind, record in export_chat_records(user_id):
+        if kind == "thread":
+            title = record["title"]
+            continue
+        writer.writerow([
+            record["thread_id"], title, record["id"], export_value(record["timestamp"]),
+            record.get("is_starred", False), record["message"], record["response"]
+        ])
+        if out.tell() >= EXPORT_CHUNK_BYTES:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+@api_router.get("/users/{user_id}/chat-export")
+async def export_chat_history(user_id: str, format: str = "ndjson"):
+    """Download every thread and message; NDJSON has one record per line, CSV one row per message"""
+    if format == "ndjson":
+        body, media_type = export_ndjson(user_id), "application/x-ndjson"
+    elif format == "csv":
+        body, media_type = export_csv(user_id), "text/csv"
+    else:
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="chat-history-{user_id}.{format}"',
+        "X-Accel-Buffering": "no"
+    })
+
+# WebSocket chat channel
+# One connection per browser tab carries every thread of a user. Clients send
+# {"type": "send_message" | "star_message" | "create_thread" | "ping", ...};
+# replies stream back on the requesting socket while thread changes are
+# pushed to all of the user's sockets.
+class ChatConnectionManager:
+    def __init__(self):
+        # user_id -> {websocket: send lock}; tasks for several threads may write at once
+        self.connections: Dict[str, Dict[WebSocket, asyncio.Lock]] = {}
+
+    def connect(self, user_id: str, websocket: WebSocket):
+        self.connections.setdefault(user_id, {})[websocket] = asyncio.Lock()
+
+    def disconnect(self, user_id: str, websocket: WebSocket):
+        sockets = self.connections.get(user_id)
+        if sockets is not None:
+            sockets.pop(websocket, None)
+            if not sockets:
+                del self.connections[user_id]
+
+    async def send(self, user_id: str, websocket: WebSocket, event: Dict[str, Any]):
+        lock = self.connections.get(user_id, {}).get(websocket)
+        if lock is None:
+            return
+        try:
+            async with lock:
+                await websocket.send_text(json.dumps(event, default=str))
+        except Exception:
+            self.disconnect(user_id, websocket)
+
+    async def broadcast(self, user_id: str, event: Dict[str, Any]):
+        for websocket in list(self.connections.get(user_id, {})):
+            await self.send(user_id, websocket, event)
+
+chat_connections = ChatConnectionManager()
+
+async def _ws_send_message(user_id: str, websocket: WebSocket, event: Dict[str, Any]):
+    """Task for one send_message event; any failure is reported to the client under its request_id"""
+    request_id = event.get("request_id")
+    try:
+        await _ws_reply_to_message(user_id, websocket, event)
+    except HTTPException as e:
+        await chat_connections.send(user_id, websocket, {
+            "type": "error", "request_id": request_id, "detail": e.detail, "status_code": e.status_code
+        })
+    except Exception:
+        logger.exception("WebSocket send_message failed")
+        await chat_connections.send(user_id, websocket, {
+            "type": "error", "request_id": request_id, "detail": "Could not process the message", "status_code": 500
+        })
+
+async def _ws_reply_to_message(user_id: str, websocket: WebSocket, event: Dict[str, Any]):
+    thread_id = event.get("thread_id")
+    text = event.get("message")
+    request_id = event.get("request_id")
+    if not thread_id or not text:
+        await chat_connections.send(user_id, websocket, {
+            "type": "error", "request_id": request_id, "detail": "thread_id and message are required"
+        })
+        return
+    context = await build_ai_context(text, user_id, thread_id)
+    if context["conversation"] is None:
+        await chat_connections.send(user_id, websocket, {
+            "type": "error", "request_id": request_id, "detail": "Chat thread not found"
+        })
+        return
+
+    message = ChatMessage(user_id=user_id, message=text, response="")
+    if event.get("message_id"):
+        message.id = event["message_id"]
+    message.context_modules = context["modules"]
+    message.context_glossary = context["terms"]
+    message.context_lessons = context["lessons"]
+    message.context_passages = context["passages"]
+    await chat_connections.send(user_id, websocket, {
+        "type": "message_context",
+        "request_id": request_id,
+        "thread_id": thread_id,
+        "message_id": message.id,
+        "modules": message.context_modules,
+        "glossary": message.context_glossary,
+        "lessons": message.context_lessons,
+        "passages": message.context_passages,
+        "locked_content": not context["has_full_access"]
+    })
+    chunks = []
+    try:
+        async for chunk in stream_ai_response(text, context):
+            chunks.append(chunk)
+            await chat_connections.send(user_id, websocket, {
+                "type": "chunk", "thread_id": thread_id, "message_id": message.id, "text": chunk
+            })
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("QGPT streaming failed")
+        await chat_connections.send(user_id, websocket, {
+            "type": "error", "request_id": request_id, "detail": QGPT_GENERATION_FAILED, "status_code": 500
+        })
+        return
+    message.response = "".join(chunks)
+    if not await save_chat_message(user_id, thread_id, message):
+        await chat_connections.send(user_id, websocket, {
+            "type": "error", "request_id": request_id, "detail": "Chat thread not found", "status_code": 404
+        })
+        return
+    await chat_connections.send(user_id, websocket, {
+        "type": "message_complete", "request_id": request_id, "thread_id": thread_id, "message": message.dict()
+    })
+
+@api_router.websocket("/users/{user_id}/ws")
+async def chat_websocket(websocket: WebSocket, user_id: str):
+    await websocket.accept()
+    chat_connections.connect(user_id, websocket)
+    pending = set()
+    try:
+        while True:
+            try:
+                event = json.loads(await websocket.receive_text())
+                kind = event.get("type")
+            except (ValueError, AttributeError):
+                await chat_connections.send(user_id, websocket, {"type": "error", "detail": "Invalid JSON event"})
+                continue
+            if kind == "send_message":
+                # Run concurrently so a long reply in one thread does not block the others
+                task = asyncio.create_task(_ws_send_message(user_id, websocket, event))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            elif kind == "star_message" and event.get("thread_id") and event.get("message_id"):
+                # Flips the star unless the event carries "starred": true/false
+                if await star_chat_message(user_id, event["thread_id"], event["message_id"], event.get("starred")) is None:
+                    await chat_connections.send(user_id, websocket, {
+                        "type": "error", "request_id": event.get("request_id"), "detail": "Message not found"
+                    })
+            elif kind == "create_thread":
+                thread = await create_chat_thread(
+                    user_id, ChatThread(user_id=user_id, title=event.get("title") or "New Strategy Discussion")
+                )
+                await chat_connections.broadcast(user_id, {
+                    "type": "thread_created", "request_id": event.get("request_id"), "thread": thread.dict()
+                })
+            elif kind == "ping":
+                await chat_connections.send(user_id, websocket, {"type": "pong"})
+            else:
+                await chat_connections.send(user_id, websocket, {
+                    "type": "error", "request_id": event.get("request_id"), "detail": f"Unsupported event: {kind}"
+                })
+    except WebSocketDisconnect:
+        pass
+    finally:
+        chat_connections.disconnect(user_id, websocket)
+        for task in pending:
+            task.cancel()
+
+async def migrate_embedded_chat_messages(batch_size: int = 100):
+    """Move messages from threads written before chat_messages existed into it, keeping a recent window"""
+    migrated = 0
+    async for thread in db.chat_threads.find({"message_count": {"$exists": False}}, batch_size=batch_size):
+        messages = thread.get("messages", [])
+        if messages:
+            # Upserts make a rerun after an interrupted migration harmless
+            await db.chat_messages.bulk_write([
+                UpdateOne(
+                    {"thread_id": thread["id"], "id": m["id"]},
+                    {"$setOnInsert": {**m, "thread_id": thread["id"], "user_id": thread["user_id"]}},
+                    upsert=True
+                )
+                for m in messages
+            ], ordered=False)
+        await db.chat_threads.update_one(
+            {"_id": thread["_id"]},
+            {"$set": {"messages": messages[-THREAD_RECENT_MESSAGES:], "message_count": len(messages)}}
+        )
+        migrated += 1
+    if migrated:
+        logger.info(f"Moved embedded messages of {migrated} chat threads into chat_messages")
 
 # User subscription endpoints
 @api_router.get("/users/{user_id}/subscription")
 async def get_user_subscription(user_id: str):
-    subscription = await db.user_subscriptions.find_one({"user_id": user_id})
-    if not subscription:
-        # Create default subscription
-        default_sub = UserSubscription(user_id=user_id, plan_type="none", has_active_subscription=False)
-        await db.user_subscriptions.insert_one(default_sub.dict())
-        return default_sub
+    # Create the default subscription on first visit in the same round trip
+    defaults = UserSubscription(user_id=user_id, plan_type="none", has_active_subscription=False).dict()
+    defaults.pop("user_id")
+    subscription = await db.user_subscriptions.find_one_and_update(
+        {"user_id": user_id},
+        {"$setOnInsert": defaults},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
     return UserSubscription(**subscription)
 
 @api_router.post("/users/{user_id}/subscription")
@@ -393,92 +1740,558 @@ async def update_user_subscription(user_id: str, subscription: UserSubscription)
         subscription.dict(),
         upsert=True
     )
+    invalidate_chat_context(user_id)
     return subscription
 
+# Dashboard
+DASHBOARD_THREAD_LIMIT = 20
+
+@api_router.get("/users/{user_id}/dashboard")
+async def get_user_dashboard(user_id: str):
+    """Everything the home screen needs for one user, fetched concurrently in one request"""
+    user_xp, summaries, subscription, threads = await asyncio.gather(
+        get_user_xp(user_id),
+        db.course_progress_summaries.find({"user_id": user_id}, {"_id": 0}).to_list(100),
+        get_user_subscription(user_id),
+        db.chat_threads.find({"user_id": user_id}, THREAD_SUMMARY_PROJECTION)
+            .sort([("last_updated", -1), ("id", -1)])
+            .limit(DASHBOARD_THREAD_LIMIT)
+            .to_list(DASHBOARD_THREAD_LIMIT)
+    )
+    return {
+        "user_id": user_id,
+        "xp": {
+            "total_xp": user_xp.total_xp,
+            "quiz_xp": user_xp.quiz_xp,
+            "glossary_xp": user_xp.glossary_xp
+        },
+        "progress": [CourseProgressSummary(**summary) for summary in summaries],
+        "subscription": {
+            "plan_type": subscription.plan_type,
+            "has_active_subscription": subscription.has_active_subscription,
+            "subscription_tier": subscription.subscription_tier,
+            "course_access": subscription.course_access
+        },
+        "chat_threads": threads
+    }
+
 # AI Response Generation (QGPT - Quantus Group Tax Strategist)
-async def generate_ai_response(user_message: str, user_id: str):
-    """Generate QGPT response with Quantus Group behavior model"""
+# Per-user chat context (subscription entitlements), cached briefly so
+# most messages cost no database reads. Writes in this process
+# invalidate it; the TTL bounds staleness from writes on other workers.
+CHAT_CONTEXT_TTL_SECONDS = 30
+CHAT_CONTEXT_MAX_USERS = 10000
+chat_context_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def invalidate_chat_context(user_id: str):
+    chat_context_cache.pop(user_id, None)
+
+async def get_user_chat_context(user_id: str) -> Dict[str, Any]:
+    cached = chat_context_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        chat_context_cache.move_to_end(user_id)
+        return cached[1]
     user_subscription = await get_user_subscription(user_id)
-    user_progress = await get_user_progress(user_id)
+    context = {
+        "has_full_access": user_subscription.plan_type == "all_access" and user_subscription.has_active_subscription,
+        "has_subscription": user_subscription.has_active_subscription,
+        "course_access": user_subscription.course_access
+    }
+    chat_context_cache[user_id] = (time.monotonic() + CHAT_CONTEXT_TTL_SECONDS, context)
+    chat_context_cache.move_to_end(user_id)
+    if len(chat_context_cache) > CHAT_CONTEXT_MAX_USERS:
+        chat_context_cache.popitem(last=False)
+    return context
+
+async def get_thread_conversation(user_id: str, thread_id: str) -> Optional[Dict[str, Any]]:
+    """Rolling summary plus the latest exchanges: one bounded read however long the thread is"""
+    thread = await db.chat_threads.find_one(
+        {"id": thread_id, "user_id": user_id},
+        {"_id": 0, "summary": 1, "messages": {"$slice": -THREAD_CONTEXT_MESSAGES}}
+    )
+    if thread is None:
+        return None
+    return {
+        "summary": thread.get("summary", ""),
+        "recent": [{"message": m["message"], "response": m["response"]} for m in thread.get("messages", [])]
+    }
+
+async def build_ai_context(user_message: str, user_id: str, thread_id: Optional[str] = None) -> Dict[str, Any]:
+    """Access level, detected strategy terms and modules, and thread conversation for one message.
+
+    "conversation" is None when thread_id is given but the thread does not exist.
+    """
+    if thread_id:
+        user_context, conversation = await asyncio.gather(
+            get_user_chat_context(user_id), get_thread_conversation(user_id, thread_id)
+        )
+    else:
+        user_context, conversation = await get_user_chat_context(user_id), {"summary": "", "recent": []}
     
-    # Detect strategy terms and modules
-    detected_terms = detect_glossary_terms(user_message)
-    related_modules = detect_related_modules(user_message)
+    # Detect strategy terms, modules and intents in one pass
+    analysis = message_analyzer.analyze(user_message)
+    # Ground the answer in lesson passages the user is entitled to read
+    passages = passage_index.search(
+        user_message, None if user_context["has_full_access"] else user_context["course_access"]
+    )
     
-    # Check access permissions
-    has_full_access = user_subscription.plan_type == "all_access" and user_subscription.has_active_subscription
-    has_subscription = user_subscription.has_active_subscription
+    return {
+        "has_full_access": user_context["has_full_access"],
+        "has_subscription": user_context["has_subscription"],
+        "course_access": user_context["course_access"],
+        "terms": analysis.terms,
+        "modules": analysis.modules,
+        "lessons": analysis.lessons,
+        "passages": passages,
+        "intents": analysis.intents,
+        "conversation": conversation
+    }
+
+# QGPT generation backends
+# Answers come from a backend behind a bounded pool: at most QGPT_CONCURRENCY
+# generations or streams run at once and up to QGPT_QUEUE_SIZE more wait.
+# Beyond that requests get 429 instead of piling up, and a request still
+# unanswered (or a stream stalled) after QGPT_TIMEOUT_SECONDS gets 503.
+QGPT_BACKEND = os.environ.get("QGPT_BACKEND", "template")  # A registered name or "package.module:Class"
+QGPT_GENERATION_FAILED = "QGPT could not generate a response, please try again"
+QGPT_CONCURRENCY = int(os.environ.get("QGPT_CONCURRENCY", "4"))
+QGPT_QUEUE_SIZE = int(os.environ.get("QGPT_QUEUE_SIZE", "100"))
+QGPT_TIMEOUT_SECONDS = float(os.environ.get("QGPT_TIMEOUT_SECONDS", "30"))
+
+class GenerationBackend(ABC):
+    """Produces QGPT answers; a max_batch_size above 1 lets the pool pass several requests per call"""
+    max_batch_size = 1
+    # Whether answers depend on context["conversation"]; if so it is part of the response cache key
+    uses_conversation = True
+    # Whether answers may draw on any of context["passages"]. Passages are
+    # filtered by course access, so every passage is then part of the key.
+    uses_passages = True
+
+    @abstractmethod
+    async def generate(self, requests: List[tuple]) -> List[str]:
+        """Answers for (message, context) pairs, in the same order.
+
+        context is build_ai_context's output, including the thread's rolling
+        summary and latest exchanges under "conversation".
+        """
+
+    async def stream(self, message: str, context: Dict[str, Any]) -> AsyncIterator[str]:
+        """The answer in pieces as it is produced.
+
+        Backends that can produce text incrementally should override this;
+        the default yields the whole answer once generate() returns.
+        """
+        (answer,) = await self.generate([(message, context)])
+        yield answer
+
+STREAM_CHUNK_WORDS = 8
+def chunk_words(text: str) -> List[str]:
+    words = re.findall(r"\S+\s*|\s+", text)
+    return ["".join(words[i:i + STREAM_CHUNK_WORDS]) for i in range(0, len(words), STREAM_CHUNK_WORDS)]
+
+class TemplateBackend(GenerationBackend):
+    """Deterministic answers from the QGPT templates; needs no model, so it also serves tests"""
+    max_batch_size = 32
+    uses_conversation = False
+    uses_passages = False  # Only the fallback answer quotes a passage, and only the first
+
+    async def generate(self, requests: List[tuple]) -> List[str]:
+        return [
+            generate_qgpt_response(
+                message, context["has_full_access"], context["has_subscription"], context["terms"], context["modules"],
+                context["intents"], context["passages"]
+            )
+            for message, context in requests
+        ]
+
+    async def stream(self, message: str, context: Dict[str, Any]) -> AsyncIterator[str]:
+        (answer,) = await self.generate([(message, context)])
+        for chunk in chunk_words(answer):
+            yield chunk
+            # Let other requests run between chunks
+            await asyncio.sleep(0)
+
+QGPT_BACKENDS = {"template": TemplateBackend}
+
+def load_generation_backend(name: str) -> GenerationBackend:
+    if name in QGPT_BACKENDS:
+        return QGPT_BACKENDS[name]()
+    module_name, _, class_name = name.partition(":")
+    if not class_name:
+        raise RuntimeError(f"Unknown QGPT_BACKEND {name!r}; use one of {sorted(QGPT_BACKENDS)} or 'package.module:Class'")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+class GenerationPool:
+    """Bounded worker pool in front of a generation backend.
+
+    Each worker takes the oldest queued request plus whatever else is
+    already waiting, up to the backend's max_batch_size. Requests whose
+    caller has timed out or gone away are dropped before generation.
+    Streams bypass the batch queue but take the same concurrency slots,
+    so batches and streams together never exceed QGPT_CONCURRENCY.
+    """
+
+    def __init__(self, backend: GenerationBackend, concurrency: int, queue_size: int, timeout: float):
+        self.backend = backend
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        # Created with the workers, inside the running loop
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.workers: List[asyncio.Task] = []
+        self.waiting_streams = 0
+        self.in_flight = 0
+        self.stats = {"completed": 0, "failed": 0, "rejected": 0, "timed_out": 0, "batches": 0, "streams": 0}
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.loop = None
+
+    def _admit(self):
+        if self.queue.qsize() + self.waiting_streams >= self.queue_size:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=429, detail="QGPT is busy, please retry shortly", headers={"Retry-After": "1"})
+
+    def _timed_out(self) -> HTTPException:
+        self.stats["timed_out"] += 1
+        return HTTPException(status_code=503, detail="QGPT is taking too long to respond", headers={"Retry-After": "5"})
+
+    async def generate(self, message: str, context: Dict[str, Any]) -> str:
+        self.start()
+        self._admit()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((message, context, future))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out()
+
+    async def stream(self, message: str, context: Dict[str, Any]) -> AsyncIterator[str]:
+        """Chunks from the backend's stream() as they arrive"""
+        self.start()
+        self._admit()
+        self.waiting_streams += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out()
+        finally:
+            self.waiting_streams -= 1
+        self.in_flight += 1
+        chunks = self.backend.stream(message, context).__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise self._timed_out()
+                yield chunk
+            self.stats["completed"] += 1
+            self.stats["streams"] += 1
+        except HTTPException:
+            raise
+        except Exception:
+            logger.exception("QGPT stream failed")
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    async def _work(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.backend.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            batch = [item for item in batch if not item[2].done()]
+            if not batch:
+                continue
+            await self.slots.acquire()
+            self.in_flight += len(batch)
+            try:
+                answers = await self.backend.generate([(message, context) for message, context, _ in batch])
+            except Exception as e:
+                logger.exception("QGPT generation failed")
+                self.stats["failed"] += len(batch)
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.stats["completed"] += len(batch)
+                self.stats["batches"] += 1
+                for (_, _, future), answer in zip(batch, answers):
+                    if not future.done():
+                        future.set_result(answer)
+            finally:
+                self.in_flight -= len(batch)
+                self.slots.release()
+
+generation_pool = GenerationPool(
+    load_generation_backend(QGPT_BACKEND), QGPT_CONCURRENCY, QGPT_QUEUE_SIZE, QGPT_TIMEOUT_SECONDS
+)
+
+@api_router.get("/admin/qgpt/pool")
+async def get_qgpt_pool_stats():
+    return {
+        **generation_pool.stats,
+        "backend": type(generation_pool.backend).__name__,
+        "concurrency": generation_pool.concurrency,
+        "queued": (generation_pool.queue.qsize() if generation_pool.queue else 0) + generation_pool.waiting_streams,
+        "queue_size": generation_pool.queue_size,
+        "in_flight": generation_pool.in_flight
+    }
+
+# Generated answers, keyed on the normalized question, routed intent and
+# access tier. The fallback answer quotes the best entitled passage, so
+# for it the passage is part of the key too.
+QGPT_CACHE_SIZE = int(os.environ.get("QGPT_CACHE_SIZE", "5000"))
+qgpt_response_cache: "OrderedDict[tuple, str]" = OrderedDict()
+qgpt_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+# Misses being generated right now; identical questions wait on the same generation
+qgpt_inflight: Dict[tuple, asyncio.Future] = {}
+
+def normalize_question(message: str) -> str:
+    return " ".join(message.lower().split()).strip(" ?!.")
+
+def conversation_digest(conversation: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not conversation or not (conversation.get("summary") or conversation.get("recent")):
+        return None
+    return hashlib.sha1(json.dumps(conversation, sort_keys=True).encode()).hexdigest()
+
+def qgpt_cache_key(user_message: str, context: Dict[str, Any]) -> tuple:
+    backend = generation_pool.backend
+    intent = route_qgpt_intent(context["intents"])
+    if backend.uses_passages:
+        passages = context["passages"]
+    else:
+        passages = context["passages"][:1] if not intent else []
+    # Answers that read the thread history are only shared within the same history
+    conversation = conversation_digest(context.get("conversation")) if backend.uses_conversation else None
+    return (
+        normalize_question(user_message), intent, context["has_full_access"], context["has_subscription"],
+        tuple((passage["lesson_id"], passage["passage"]) for passage in passages), conversation
+    )
+
+def clear_qgpt_cache():
+    qgpt_response_cache.clear()
+
+def _remember_qgpt_response(key: tuple, response: str):
+    qgpt_response_cache[key] = response
+    qgpt_response_cache.move_to_end(key)
+    if len(qgpt_response_cache) > QGPT_CACHE_SIZE:
+        qgpt_response_cache.popitem(last=False)
+        qgpt_cache_stats["evictions"] += 1
+
+def _store_qgpt_response(key: tuple, generation: asyncio.Future):
+    qgpt_inflight.pop(key, None)
+    if generation.cancelled() or generation.exception() is not None:
+        return
+    _remember_qgpt_response(key, generation.result())
+
+async def cached_qgpt_response(user_message: str, context: Dict[str, Any]) -> str:
+    key = qgpt_cache_key(user_message, context)
+    response = qgpt_response_cache.get(key)
+    if response is not None:
+        qgpt_cache_stats["hits"] += 1
+        qgpt_response_cache.move_to_end(key)
+        return response
+    generation = qgpt_inflight.get(key)
+    if generation is None:
+        qgpt_cache_stats["misses"] += 1
+        generation = asyncio.ensure_future(generation_pool.generate(user_message, context))
+        qgpt_inflight[key] = generation
+        generation.add_done_callback(lambda done: _store_qgpt_response(key, done))
+    else:
+        qgpt_cache_stats["coalesced"] += 1
+    # One caller going away must not cancel the answer others are waiting for
+    return await asyncio.shield(generation)
+
+@api_router.get("/admin/qgpt/cache")
+async def get_qgpt_cache_stats():
+    lookups = qgpt_cache_stats["hits"] + qgpt_cache_stats["misses"] + qgpt_cache_stats["coalesced"]
+    return {
+        **qgpt_cache_stats,
+        "size": len(qgpt_response_cache),
+        "capacity": QGPT_CACHE_SIZE,
+        "hit_rate": round((qgpt_cache_stats["hits"] + qgpt_cache_stats["coalesced"]) / lookups, 4) if lookups else 0.0
+    }
+
+async def generate_ai_response(user_message: str, user_id: str, thread_id: Optional[str] = None):
+    """Generate QGPT response with Quantus Group behavior model"""
+    context = await build_ai_context(user_message, user_id, thread_id)
+    if context["conversation"] is None:
+        raise HTTPException(status_code=404, detail="Chat thread not found")
     
     # Generate QGPT response based on question type and access level
-    response = generate_qgpt_response(user_message, has_full_access, has_subscription, detected_terms, related_modules)
+    response = await cached_qgpt_response(user_message, context)
     
     return {
         "response": response,
-        "modules": related_modules,
-        "glossary": detected_terms,
-        "locked_content": not has_full_access
+        "modules": context["modules"],
+        "glossary": context["terms"],
+        "lessons": context["lessons"],
+        "passages": context["passages"],
+        "locked_content": not context["has_full_access"]
     }
 
-def generate_qgpt_response(message: str, has_full_access: bool, has_subscription: bool, terms: List[str], modules: List[str]) -> str:
-    """Generate QGPT responses following Quantus Group behavior model"""
-    
-    # Common QGPT responses based on question patterns
-    qgpt_responses = {
-        "reps": {
-            "strategy": "**Real Estate Professional Status (REPS)**",
-            "what_it_does": "Transforms your real estate losses from passive to active, letting them offset W-2 income dollar-for-dollar.",
-            "when_applies": "W-2 earners with rental properties who can dedicate 750+ hours annually to real estate activities.",
-            "key_rules": "Two tests: 750-hour minimum AND more than 50% of your total work time in real estate.",
-            "example": "Sarah, a $200K software engineer, qualified for REPS and used $180K in rental depreciation to zero out her W-2 taxes.",
-            "next_step": "Start with Module 4: REPS Qualification, then use the REPS Hour Tracker."
-        },
-        "w2_offset": {
-            "strategy": "**W-2 Income Offset Strategy**",
-            "what_it_does": "Uses business depreciation and real estate losses to legally eliminate taxes on your salary.",
-            "when_applies": "High-income W-2 earners ($150K+) who want to keep their job while minimizing taxes.",
-            "key_rules": "Must qualify for material participation (750+ hours for STR) or have legitimate business expenses.",
-            "example": "Tech executive earning $300K used STR depreciation to reduce taxable income to $50K.",
-            "next_step": "See Module 2: Repositioning W-2 Income, then try the W-2 Offset Planner."
-        },
-        "cost_segregation": {
-            "strategy": "**Cost Segregation Study**",
-            "what_it_does": "Accelerates depreciation by reclassifying building components into shorter asset lives (5-7 years vs 27.5 years).",
-            "when_applies": "Real estate investors with properties over $500K who want massive first-year deductions.",
-            "key_rules": "Requires professional study, works best on commercial or high-value residential properties.",
-            "example": "Investor bought $2M rental, cost seg generated $400K first-year depreciation vs $72K standard.",
-            "next_step": "Review Module 3: Offset Stacking, then use the Cost Segregation ROI Estimator."
-        },
-        "qof": {
-            "strategy": "**Qualified Opportunity Fund (QOF)**",
-            "what_it_does": "Defers capital gains taxes while investing in opportunity zone real estate or businesses.",
-            "when_applies": "Anyone with significant capital gains (RSUs, property sales, crypto) looking to defer taxes.",
-            "key_rules": "Must invest within 180 days, hold for 10+ years for maximum benefits.",
-            "example": "Helen invested $500K RSU gains into QOF, deferred $170K in taxes while building rental portfolio.",
-            "next_step": "Study Module 2: Repositioning strategies, then explore QOF investment options."
-        }
+async def stream_ai_response(user_message: str, context: Dict[str, Any]):
+    """Yield the QGPT response in chunks as it is produced.
+
+    Cached or already in-flight answers are replayed in chunks; otherwise
+    chunks are forwarded from the backend as they arrive and the full
+    answer is cached once the stream completes.
+    """
+    key = qgpt_cache_key(user_message, context)
+    response = qgpt_response_cache.get(key)
+    if response is None and key in qgpt_inflight:
+        qgpt_cache_stats["coalesced"] += 1
+        response = await asyncio.shield(qgpt_inflight[key])
+    elif response is not None:
+        qgpt_cache_stats["hits"] += 1
+        qgpt_response_cache.move_to_end(key)
+    if response is not None:
+        for chunk in chunk_words(response):
+            yield chunk
+            # Let other requests run between chunks
+            await asyncio.sleep(0)
+        return
+    qgpt_cache_stats["misses"] += 1
+    chunks = []
+    async for chunk in generation_pool.stream(user_message, context):
+        chunks.append(chunk)
+        yield chunk
+    _remember_qgpt_response(key, "".join(chunks))
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton: every occurrence of every keyword in one pass over the text.
+
+    Keywords match as plain substrings, like `keyword in text`, including
+    overlapping ones. Failure links are folded into a complete transition
+    table at build(), so scanning costs one dict lookup per character no
+    matter how many keywords there are. Call build() after the last add().
+    """
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.outputs: List[List[tuple]] = [[]]
+        self.delta: List[Dict[str, int]] = []
+
+    def add(self, keyword: str, payload: Any):
+        state = 0
+        for ch in keyword:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.goto[state][ch] = nxt
+            state = nxt
+        self.outputs[state].append((len(keyword), payload))
+
+    def build(self):
+        self.delta = [{} for _ in self.goto]
+        self.delta[0] = dict(self.goto[0])
+        # Breadth-first, so a state's failure target is always complete before it
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            fallback = self.fail[state]
+            self.delta[state] = {**self.delta[fallback], **self.goto[state]}
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                self.fail[nxt] = self.delta[fallback].get(ch, 0)
+                self.outputs[nxt] = self.outputs[nxt] + self.outputs[self.fail[nxt]]
+
+    def findall(self, text: str) -> List[tuple]:
+        """(start, end, payload) for each keyword occurrence, in order of where it ends"""
+        delta, outputs = self.delta, self.outputs
+        found = []
+        state = 0
+        for i, ch in enumerate(text):
+            state = delta[state].get(ch, 0)
+            if outputs[state]:
+                for length, payload in outputs[state]:
+                    found.append((i - length + 1, i + 1, payload))
+        return found
+
+# QGPT intent rules, in priority order: when a message matches several
+# intents the first one listed wins. "premium_topic" only gates access.
+QGPT_INTENT_KEYWORDS = {
+    "premium_topic": ["split-dollar", "installment sales", "qsbs", "advanced"],
+    "reps": ["reps", "real estate professional"],
+    "w2_offset": ["w-2 offset", "w2 offset", "salary offset"],
+    "cost_segregation": ["cost segregation", "cost seg", "depreciation study"],
+    "qof": ["qof", "opportunity fund", "opportunity zone"],
+    "help": ["help", "start", "begin", "new"],
+}
+
+# Common QGPT responses based on question patterns
+QGPT_STRATEGIES = {
+    "reps": {
+        "strategy": "**Real Estate Professional Status (REPS)**",
+        "what_it_does": "Transforms your real estate losses from passive to active, letting them offset W-2 income dollar-for-dollar.",
+        "when_applies": "W-2 earners with rental properties who can dedicate 750+ hours annually to real estate activities.",
+        "key_rules": "Two tests: 750-hour minimum AND more than 50% of your total work time in real estate.",
+        "example": "Sarah, a $200K software engineer, qualified for REPS and used $180K in rental depreciation to zero out her W-2 taxes.",
+        "next_step": "Start with Module 4: REPS Qualification, then use the REPS Hour Tracker."
+    },
+    "w2_offset": {
+        "strategy": "**W-2 Income Offset Strategy**",
+        "what_it_does": "Uses business depreciation and real estate losses to legally eliminate taxes on your salary.",
+        "when_applies": "High-income W-2 earners ($150K+) who want to keep their job while minimizing taxes.",
+        "key_rules": "Must qualify for material participation (750+ hours for STR) or have legitimate business expenses.",
+        "example": "Tech executive earning $300K used STR depreciation to reduce taxable income to $50K.",
+        "next_step": "See Module 2: Repositioning W-2 Income, then try the W-2 Offset Planner."
+    },
+    "cost_segregation": {
+        "strategy": "**Cost Segregation Study**",
+        "what_it_does": "Accelerates depreciation by reclassifying building components into shorter asset lives (5-7 years vs 27.5 years).",
+        "when_applies": "Real estate investors with properties over $500K who want massive first-year deductions.",
+        "key_rules": "Requires professional study, works best on commercial or high-value residential properties.",
+        "example": "Investor bought $2M rental, cost seg generated $400K first-year depreciation vs $72K standard.",
+        "next_step": "Review Module 3: Offset Stacking, then use the Cost Segregation ROI Estimator."
+    },
+    "qof": {
+        "strategy": "**Qualified Opportunity Fund (QOF)**",
+        "what_it_does": "Defers capital gains taxes while investing in opportunity zone real estate or businesses.",
+        "when_applies": "Anyone with significant capital gains (RSUs, property sales, crypto) looking to defer taxes.",
+        "key_rules": "Must invest within 180 days, hold for 10+ years for maximum benefits.",
+        "example": "Helen invested $500K RSU gains into QOF, deferred $170K in taxes while building rental portfolio.",
+        "next_step": "Study Module 2: Repositioning strategies, then explore QOF investment options."
     }
-    
-    # Detect question intent
-    message_lower = message.lower()
-    
-    # Handle gated content
-    if not has_subscription:
-        return "That strategy requires an active subscription. **Upgrade to unlock full QGPT support and access all premium tools.**"
-    
-    if not has_full_access and any(topic in message_lower for topic in ["split-dollar", "installment sales", "qsbs", "advanced"]):
-        return "That advanced strategy is covered in our premium modules. **Upgrade to All Access ($69/mo) to unlock complete QGPT guidance.**"
-    
-    # Generate contextual responses
-    if any(term in message_lower for term in ["reps", "real estate professional"]):
-        strategy = qgpt_responses["reps"]
-    elif any(term in message_lower for term in ["w-2 offset", "w2 offset", "salary offset"]):
-        strategy = qgpt_responses["w2_offset"]
-    elif any(term in message_lower for term in ["cost segregation", "cost seg", "depreciation study"]):
-        strategy = qgpt_responses["cost_segregation"]
-    elif any(term in message_lower for term in ["qof", "opportunity fund", "opportunity zone"]):
-        strategy = qgpt_responses["qof"]
-    elif any(term in message_lower for term in ["help", "start", "begin", "new"]):
-        return """I'm **QGPT**, your AI tax strategist for the IRS Escape Plan.
+}
+
+QGPT_STRATEGY_TEMPLATE = """{strategy}
+
+**What It Does:** {what_it_does}
+
+**When It Applies:** {when_applies}
+
+**Key Rules:** {key_rules}
+
+**Example:** {example}
+
+**Next Step:** {next_step}"""
+
+QGPT_HELP_RESPONSE = """I'm **QGPT**, your AI tax strategist for the IRS Escape Plan.
 
 I help you understand and apply advanced tax strategies from your courses. Here's how to get started:
 
@@ -493,9 +2306,8 @@ I help you understand and apply advanced tax strategies from your courses. Here'
 • Help you apply concepts to your situation
 
 What specific tax challenge are you trying to solve?"""
-    else:
-        # Generic strategic response
-        return f"""Here's what I know about "{message[:50]}..."
+
+QGPT_FALLBACK_TEMPLATE = """Here's what I know about "{message}..."
 
 **Strategy Context:** This relates to advanced tax planning that requires specific qualification rules and implementation steps.
 
@@ -508,121 +2320,844 @@ What specific tax challenge are you trying to solve?"""
 
 The more specific your question, the better I can guide you to the exact strategy and tools you need.
 
-**Related:** {', '.join(terms) if terms else 'General tax strategy'}"""
-    
-    # Format full strategy response
-    if 'strategy' in locals():
-        response = f"""{strategy['strategy']}
+**Related:** {related}"""
+
+QGPT_PASSAGE_TEMPLATE = """
+
+**From {label} ({title}):**
+{text}"""
+
+QGPT_SUBSCRIPTION_REQUIRED = "That strategy requires an active subscription. **Upgrade to unlock full QGPT support and access all premium tools.**"
+QGPT_PREMIUM_REQUIRED = "That advanced strategy is covered in our premium modules. **Upgrade to All Access ($69/mo) to unlock complete QGPT guidance.**"
+
+# Keyword tables for message analysis
+GLOSSARY_DETECTION_TERMS = [
+    "REPS", "Real Estate Professional Status", "QBI", "Cost Segregation", 
+    "W-2 Income", "Depreciation", "QOF", "Qualified Opportunity Fund",
+    "Short-Term Rental", "STR", "Material Participation", "Bonus Depreciation",
+    "Offset Stacking", "Repositioning", "Effective Tax Rate", "Forward-Looking Planning"
+]
+
+# Module links are derived from stored course content (see ModuleKeywordIndex)
+BOLD_TERM_PATTERN = re.compile(r"\*\*([^*\n]+)\*\*")
+ACRONYM_PATTERN = re.compile(r"^(.*\S)\s*\(([^()\s]{2,10})\)$")
+MODULE_KEYWORD_MAX_WORDS = 5  # Longer bold text is a sentence, not a term
+MODULE_KEYWORD_MAX_LESSONS = 3
+MODULE_KEYWORD_WEIGHTS = {"title": 3, "bold": 2, "glossary": 1}
+COURSE_INDEX_REFRESH_SECONDS = int(os.environ.get("COURSE_INDEX_REFRESH_SECONDS", "300"))
+
+def keyword_variants(phrase: str) -> List[str]:
+    """Lowercased keywords for a phrase; "Short-Term Rental (STR)" gives both the name and the acronym"""
+    phrase = " ".join(phrase.split()).strip(" .,;!?\"'").lower()
+    match = ACRONYM_PATTERN.match(phrase)
+    variants = [match.group(1), match.group(2)] if match else [phrase]
+    return [v for v in variants if len(v) >= 3 or (len(v) >= 2 and v.isalpha())]
+
+def lesson_ref(course: Dict[str, Any], lesson: Dict[str, Any]) -> Dict[str, Any]:
+    """Deep link to a lesson, as attached to chat messages"""
+    return {
+        "course_id": course["id"],
+        "lesson_id": lesson["id"],
+        "title": lesson["title"],
+        "label": f"{course['title']} - Module {lesson['order_index']}"
+    }
+
+def lesson_digest(ref: Dict[str, Any], lesson: Dict[str, Any]) -> str:
+    return hashlib.sha1("\0".join([ref["label"], lesson["title"], lesson.get("content", "")]).encode()).hexdigest()
+
+def is_whole_word(text: str, start: int, end: int) -> bool:
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+def extract_lesson_keywords(title: str, content: str, glossary_automaton: "KeywordAutomaton") -> Dict[str, int]:
+    """Keyword -> weight for one lesson, from its title, bold terms and glossary mentions"""
+    weights: Dict[str, int] = {}
+    for part in title.split(" — "):
+        for keyword in keyword_variants(part):
+            weights[keyword] = weights.get(keyword, 0) + MODULE_KEYWORD_WEIGHTS["title"]
+    for bold in BOLD_TERM_PATTERN.findall(content):
+        if ":" in bold or len(bold.split()) > MODULE_KEYWORD_MAX_WORDS:
+            continue
+        for keyword in keyword_variants(bold):
+            weights[keyword] = weights.get(keyword, 0) + MODULE_KEYWORD_WEIGHTS["bold"]
+    text = content.lower()
+    for start, end, keyword in glossary_automaton.findall(text):
+        if is_whole_word(text, start, end):
+            weights[keyword] = weights.get(keyword, 0) + MODULE_KEYWORD_WEIGHTS["glossary"]
+    return weights
+
+class ModuleKeywordIndex:
+    """Keyword -> lesson links built from the courses and glossary in the database.
+
+    Each lesson's keywords are cached under a hash of its text, so sync()
+    only re-extracts lessons that changed; a change to the glossary term
+    set re-extracts everything. Each keyword links to the lessons that
+    weight it most heavily.
+    """
+
+    def __init__(self):
+        self.lessons: Dict[str, Dict[str, Any]] = {}  # lesson id -> {"hash", "ref", "keywords"}
+        self.glossary_keywords: tuple = ()
+        self.glossary_automaton = KeywordAutomaton()
+        self.keywords: Dict[str, List[Dict[str, Any]]] = {}
+
+    def sync(self, courses: List[Dict[str, Any]], glossary_terms: List[str]) -> bool:
+        """Bring the index up to date; returns whether any keyword links changed"""
+        glossary_keywords = tuple(sorted({k for term in glossary_terms for k in keyword_variants(term)}))
+        glossary_changed = glossary_keywords != self.glossary_keywords
+        if glossary_changed:
+            self.glossary_keywords = glossary_keywords
+            self.glossary_automaton = KeywordAutomaton()
+            for keyword in glossary_keywords:
+                self.glossary_automaton.add(keyword, keyword)
+            self.glossary_automaton.build()
+
+        changed = glossary_changed
+        seen = set()
+        for course in courses:
+            for lesson in course.get("lessons", []):
+                ref = lesson_ref(course, lesson)
+                digest = lesson_digest(ref, lesson)
+                seen.add(lesson["id"])
+                entry = self.lessons.get(lesson["id"])
+                if entry and entry["hash"] == digest and not glossary_changed:
+                    continue
+                self.lessons[lesson["id"]] = {
+                    "hash": digest,
+                    "ref": ref,
+                    "keywords": extract_lesson_keywords(lesson["title"], lesson.get("content", ""), self.glossary_automaton)
+                }
+                changed = True
+        for lesson_id in set(self.lessons) - seen:
+            del self.lessons[lesson_id]
+            changed = True
+
+        if changed:
+            ranked: Dict[str, List[tuple]] = {}
+            for entry in self.lessons.values():
+                for keyword, weight in entry["keywords"].items():
+                    ranked.setdefault(keyword, []).append((-weight, entry["ref"]["label"], entry["ref"]))
+            self.keywords = {
+                keyword: [ref for _, _, ref in sorted(candidates, key=lambda c: c[:2])[:MODULE_KEYWORD_MAX_LESSONS]]
+                for keyword, candidates in ranked.items()
+            }
+        return changed
+
+module_index = ModuleKeywordIndex()
+
+# BM25 passage retrieval over lesson content
+BM25_K1 = 1.2
+BM25_B = 0.75
+PASSAGE_MIN_CHARS = 200  # Headings and one-line paragraphs merge into the next paragraph
+PASSAGE_SNIPPET_CHARS = 300
+QGPT_PASSAGE_LIMIT = 3
+SEARCH_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-'&][a-z0-9]+)*")
+SEARCH_STOPWORDS = frozenset(
+    "a about all also an and any are as at be but by can could do does for from has have how i if in into is it its "
+    "me my no not of on or our should so than that the their them then there these they this to up was we what when "
+    "which who why will with would you your".split()
+)
+
+def search_tokens(text: str) -> List[str]:
+    return [token for token in SEARCH_TOKEN_PATTERN.findall(text.lower()) if token not in SEARCH_STOPWORDS]
+
+def split_passages(content: str) -> List[str]:
+    passages = []
+    pending = ""
+    for paragraph in re.split(r"\n\s*\n", content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pending = f"{pending}\n\n{paragraph}" if pending else paragraph
+        if len(pending) >= PASSAGE_MIN_CHARS:
+            passages.append(pending)
+            pending = ""
+    if pending:
+        passages.append(pending)
+    return passages
+
+class PassageIndex:
+    """In-process BM25 index over paragraph-level passages of every lesson.
+
+    Passages and their term counts are cached per lesson under a hash of
+    its text, so sync() only re-splits lessons that changed. Postings hold
+    each passage's precomputed BM25 term weight, so a query is a sum of
+    lookups over the postings of its own terms.
+    """
+
+    def __init__(self):
+        self.lessons: Dict[str, Dict[str, Any]] = {}  # lesson id -> {"hash", "passages": [(ref, counts, length)]}
+        self.free_courses: set = set()
+        self.refs: List[Dict[str, Any]] = []
+        self.postings: Dict[str, List[tuple]] = {}  # term -> [(passage number, weight)]
+
+    def sync(self, courses: List[Dict[str, Any]]) -> bool:
+        """Bring the index up to date; returns whether any passages changed"""
+        self.free_courses = {course["id"] for course in courses if course.get("is_free")}
+        changed = False
+        seen = set()
+        for course in courses:
+            for lesson in course.get("lessons", []):
+                ref = lesson_ref(course, lesson)
+                digest = lesson_digest(ref, lesson)
+                seen.add(lesson["id"])
+                entry = self.lessons.get(lesson["id"])
+                if entry and entry["hash"] == digest:
+                    continue
+                passages = []
+                for number, text in enumerate(split_passages(lesson.get("content", ""))):
+                    tokens = search_tokens(text)
+                    counts: Dict[str, int] = {}
+                    for token in tokens:
+                        counts[token] = counts.get(token, 0) + 1
+                    passages.append(({**ref, "passage": number, "text": text}, counts, len(tokens)))
+                self.lessons[lesson["id"]] = {"hash": digest, "passages": passages}
+                changed = True
+        for lesson_id in set(self.lessons) - seen:
+            del self.lessons[lesson_id]
+            changed = True
+        if changed:
+            self._build_postings()
+        return changed
+
+    def _build_postings(self):
+        passages = [passage for entry in self.lessons.values() for passage in entry["passages"]]
+        # Passages of nothing but stopwords have no tokens; keep the length norm defined
+        avg_length = (sum(length for _, _, length in passages) / len(passages) if passages else 0.0) or 1.0
+        document_frequency: Dict[str, int] = {}
+        for _, counts, _ in passages:
+            for term in counts:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        total = len(passages)
+        idf = {term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+        postings: Dict[str, List[tuple]] = {}
+        for number, (_, counts, length) in enumerate(passages):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((number, idf[term] * tf * (BM25_K1 + 1) / (tf + norm)))
+        self.refs = [ref for ref, _, _ in passages]
+        self.postings = postings
+
+    def search(self, query: str, course_ids: Optional[set] = None, limit: int = QGPT_PASSAGE_LIMIT) -> List[Dict[str, Any]]:
+        """Best passages for a query, at most one per lesson.
+
+        course_ids limits results to courses the reader is entitled to (free
+        courses are always included); None searches every course.
+        """
+        scores: Dict[int, float] = {}
+        for term in set(search_tokens(query)):
+            for number, weight in self.postings.get(term, ()):
+                scores[number] = scores.get(number, 0.0) + weight
+        allowed = None if course_ids is None else set(course_ids) | self.free_courses
+        results = []
+        lessons = set()
+        for number, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+            ref = self.refs[number]
+            if (allowed is not None and ref["course_id"] not in allowed) or ref["lesson_id"] in lessons:
+                continue
+            lessons.add(ref["lesson_id"])
+            text = ref["text"]
+            if len(text) > PASSAGE_SNIPPET_CHARS:
+                text = text[:PASSAGE_SNIPPET_CHARS].rsplit(" ", 1)[0] + "..."
+            results.append({**ref, "text": text, "score": round(score, 3)})
+            if len(results) == limit:
+                break
+        return results
+
+passage_index = PassageIndex()
+
+# Hashed-feature TF-IDF vectors for related lessons, related terms and similar questions
+SIMILARITY_FEATURES = 1 << 18
+SIMILARITY_KINDS = ("lesson", "glossary", "question")
+SIMILARITY_INDEX_DIR = Path(os.environ.get("SIMILARITY_INDEX_DIR", ROOT_DIR / "similarity_index"))
+SIMILARITY_FLUSH_ROWS = 256  # Live-appended questions are written out once this many build up
+SIMILARITY_QUERY_CHUNK = 16
+SIMILARITY_FIT_BATCH = 1000  # Questions vectorized per step of a refit
+SIMILARITY_QUESTION_GRACE_SECONDS = 60  # Catch up on questions other workers stored slightly out of order
+
+def feature_counts(text: str) -> Dict[int, int]:
+    """Hashed unigram and bigram counts; crc32 keeps feature ids stable across workers"""
+    tokens = search_tokens(text)
+    counts: Dict[int, int] = {}
+    for gram in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+        feature = zlib.crc32(gram.encode()) & (SIMILARITY_FEATURES - 1)
+        counts[feature] = counts.get(feature, 0) + 1
+    return counts
+
+class SparseRows:
+    """L2-normalized TF-IDF rows in CSR form: three NumPy arrays, no SciPy needed"""
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @classmethod
+    def term_frequencies(cls, rows: List[Dict[int, int]]) -> "SparseRows":
+        """Unweighted 1 + log(tf) rows; weighted() turns them into TF-IDF rows"""
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(counts) for counts in rows])
+        indices = np.zeros(indptr[-1], dtype=np.int32)
+        data = np.zeros(indptr[-1], dtype=np.float32)
+        for i, counts in enumerate(rows):
+            columns = sorted(counts)
+            indices[indptr[i]:indptr[i + 1]] = columns
+            data[indptr[i]:indptr[i + 1]] = [counts[c] for c in columns]
+        return cls(indptr, indices, (1 + np.log(data)).astype(np.float32) if len(data) else data)
+
+    @classmethod
+    def from_counts(cls, rows: List[Dict[int, int]], idf: np.ndarray) -> "SparseRows":
+        return cls.term_frequencies(rows).weighted(idf)
+
+    def weighted(self, idf: np.ndarray) -> "SparseRows":
+        data = self.data * idf[self.indices]
+        lengths = np.diff(self.indptr)
+        nonempty = lengths > 0
+        norms = np.ones(len(self), dtype=np.float32)
+        if len(data):
+            norms[nonempty] = np.sqrt(np.add.reduceat(data * data, self.indptr[:-1][nonempty]))
+            norms[norms == 0] = 1
+        return SparseRows(self.indptr, self.indices, (data / np.repeat(norms, lengths)).astype(np.float32))
+
+    @classmethod
+    def concatenate(cls, parts: List["SparseRows"]) -> "SparseRows":
+        offsets = np.cumsum([0] + [len(part.data) for part in parts[:-1]])
+        return cls(
+            np.concatenate([[0]] + [part.indptr[1:] + offset for part, offset in zip(parts, offsets)]).astype(np.int64),
+            np.concatenate([part.indices for part in parts]).astype(np.int32),
+            np.concatenate([part.data for part in parts]).astype(np.float32)
+        )
 
-**What It Does:** {strategy['what_it_does']}
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def dense(self, row: int) -> np.ndarray:
+        vector = np.zeros(SIMILARITY_FEATURES, dtype=np.float32)
+        start, end = self.indptr[row], self.indptr[row + 1]
+        vector[self.indices[start:end]] = self.data[start:end]
+        return vector
+
+    def dot(self, queries: np.ndarray) -> np.ndarray:
+        """Cosine scores of dense, normalized query rows against every row: shape (queries, rows)"""
+        scores = np.zeros((len(queries), len(self)), dtype=np.float32)
+        if not len(self.data):
+            return scores
+        starts = self.indptr[:-1]
+        nonempty = starts < self.indptr[1:]
+        for i in range(0, len(queries), SIMILARITY_QUERY_CHUNK):
+            products = queries[i:i + SIMILARITY_QUERY_CHUNK][:, self.indices] * self.data
+            scores[i:i + SIMILARITY_QUERY_CHUNK, nonempty] = np.add.reduceat(products, starts[nonempty], axis=1)
+        return scores
+
+def similarity_row(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: doc.get(key) for key in ("kind", "id", "owner", "ref")}
+
+class SimilarityFit:
+    """Documents for a refit, added in batches.
+
+    Only compact term-frequency rows and document frequencies are kept, so
+    a refit never holds every question's text at once.
+    """
+
+    def __init__(self):
+        self.parts: List[SparseRows] = []
+        self.rows: List[Dict[str, Any]] = []
+        self.df = np.zeros(SIMILARITY_FEATURES, dtype=np.int32)
+
+    def add(self, documents: List[Dict[str, Any]]):
+        part = SparseRows.term_frequencies([feature_counts(doc["text"]) for doc in documents])
+        np.add.at(self.df, part.indices, 1)
+        self.parts.append(part)
+        self.rows.extend(similarity_row(doc) for doc in documents)
+
+class SimilarityIndex:
+    """TF-IDF vectors for lessons, glossary definitions and past chat questions.
+
+    IDF is frozen when the index is fitted, so new questions are appended
+    without reweighting existing rows. The fitted matrix is saved as .npy
+    files in a versioned directory and memory-mapped on load, so workers
+    share one copy through the page cache instead of each re-vectorizing
+    every lesson at startup. Appended rows stay in memory until flushed;
+    their matrix is rebuilt lazily, at most once per query after appends.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.version: Optional[str] = None
+        self.fingerprint: Optional[str] = None
+        self.last_question_at: Optional[datetime] = None
+        self.idf: Optional[np.ndarray] = None
+        self._set_base(SparseRows.term_frequencies([]), [])
+
+    @property
+    def ready(self) -> bool:
+        return self.idf is not None
+
+    def _set_base(self, base: SparseRows, rows: List[Dict[str, Any]]):
+        self.base = base
+        self.base_rows = rows
+        self.base_kinds = np.array([SIMILARITY_KINDS.index(row["kind"]) for row in rows], dtype=np.int8)
+        self.base_owners = np.array([row.get("owner") for row in rows], dtype=object)
+        self.row_numbers = {(row["kind"], row["id"]): i for i, row in enumerate(rows)}
+        self.pending_counts: List[Dict[int, int]] = []
+        self.pending_rows: List[Dict[str, Any]] = []
+        self._pending: Optional[SparseRows] = None
+
+    def _row(self, number: int) -> Dict[str, Any]:
+        return self.base_rows[number] if number < len(self.base_rows) else self.pending_rows[number - len(self.base_rows)]
+
+    @property
+    def pending(self) -> SparseRows:
+        if self._pending is None:
+            self._pending = SparseRows.from_counts(self.pending_counts, self.idf)
+            pending_kinds = [SIMILARITY_KINDS.index(row["kind"]) for row in self.pending_rows]
+            self.kinds = np.concatenate([self.base_kinds, np.array(pending_kinds, dtype=np.int8)])
+            pending_owners = np.array([row.get("owner") for row in self.pending_rows], dtype=object)
+            self.owners = np.concatenate([self.base_owners, pending_owners])
+        return self._pending
+
+    def fit(self, fitting: SimilarityFit, fingerprint: str, last_question_at: Optional[datetime]):
+        """Replace the index with the documents gathered in fitting"""
+        self.idf = (np.log((1 + len(fitting.rows)) / (1 + fitting.df)) + 1).astype(np.float32)
+        base = SparseRows.concatenate(fitting.parts) if fitting.parts else SparseRows.term_frequencies([])
+        self._set_base(base.weighted(self.idf), fitting.rows)
+        self.fingerprint = fingerprint
+        self.last_question_at = last_question_at
+
+    def append(self, documents: List[Dict[str, Any]]) -> int:
+        """Add rows weighted with the frozen IDF; rows already indexed are skipped"""
+        added = 0
+        for doc in documents:
+            key = (doc["kind"], doc["id"])
+            if key in self.row_numbers:
+                continue
+            self.row_numbers[key] = len(self.base_rows) + len(self.pending_rows)
+            self.pending_counts.append(feature_counts(doc["text"]))
+            self.pending_rows.append(similarity_row(doc))
+            added += 1
+        if added:
+            self._pending = None
+        return added
+
+    def snapshot(self) -> Dict[str, Any]:
+        """What save() writes; taking it is cheap, so it can happen on the event loop"""
+        return {
+            "base": self.base, "idf": self.idf, "fingerprint": self.fingerprint,
+            "last_question_at": self.last_question_at,
+            "rows": self.base_rows, "pending_rows": list(self.pending_rows), "pending_counts": list(self.pending_counts)
+        }
 
-**When It Applies:** {strategy['when_applies']}
+    def write(self, snapshot: Dict[str, Any]):
+        """Write a snapshot as a new version and point CURRENT at it; safe to run in a thread"""
+        version = f"{int(time.time() * 1000)}-{os.getpid()}"
+        path = self.directory / version
+        path.mkdir(parents=True, exist_ok=True)
+        matrix = SparseRows.concatenate([snapshot["base"], SparseRows.from_counts(snapshot["pending_counts"], snapshot["idf"])])
+        for name, array in (("indptr", matrix.indptr), ("indices", matrix.indices), ("data", matrix.data), ("idf", snapshot["idf"])):
+            np.save(path / f"{name}.npy", array)
+        last_question_at = snapshot["last_question_at"]
+        (path / "rows.json").write_text(json.dumps({
+            "fingerprint": snapshot["fingerprint"],
+            "last_question_at": last_question_at.isoformat() if last_question_at else None,
+            "rows": snapshot["rows"] + snapshot["pending_rows"]
+        }, default=str))
+        current = self.directory / "CURRENT"
+        (self.directory / f"CURRENT.{version}").write_text(version)
+        os.replace(self.directory / f"CURRENT.{version}", current)
+        # Keep the previous version for workers that have not reloaded yet
+        versions = sorted(p for p in self.directory.iterdir() if p.is_dir())
+        for old in versions[:-2]:
+            for file in old.iterdir():
+                file.unlink()
+            old.rmdir()
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        """The newest saved version if it differs from the loaded one; safe to run in a thread"""
+        try:
+            version = (self.directory / "CURRENT").read_text().strip()
+        except FileNotFoundError:
+            return None
+        if version == self.version:
+            return None
+        path = self.directory / version
+        meta = json.loads((path / "rows.json").read_text())
+        return {
+            "version": version,
+            "meta": meta,
+            "arrays": {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ("indptr", "indices", "data", "idf")}
+        }
 
-**Key Rules:** {strategy['key_rules']}
+    def apply(self, loaded: Dict[str, Any]):
+        """Switch to a version returned by read(), keeping appended rows it does not hold"""
+        meta, arrays = loaded["meta"], loaded["arrays"]
+        pending = list(zip(self.pending_rows, self.pending_counts))
+        self.version = loaded["version"]
+        self.fingerprint = meta["fingerprint"]
+        self.last_question_at = datetime.fromisoformat(meta["last_question_at"]) if meta["last_question_at"] else None
+        self.idf = arrays["idf"]
+        self._set_base(SparseRows(arrays["indptr"], arrays["indices"], arrays["data"]), meta["rows"])
+        for row, counts in pending:
+            key = (row["kind"], row["id"])
+            if key not in self.row_numbers:
+                self.row_numbers[key] = len(self.base_rows) + len(self.pending_rows)
+                self.pending_rows.append(row)
+                self.pending_counts.append(counts)
+
+    def save(self):
+        self.write(self.snapshot())
+        self.load()
+
+    def load(self) -> bool:
+        loaded = self.read()
+        if loaded is None:
+            return False
+        self.apply(loaded)
+        return True
+
+    async def flush(self):
+        """save() with the file writes and reads off the event loop"""
+        await asyncio.to_thread(self.write, self.snapshot())
+        await self.reload()
+
+    async def reload(self) -> bool:
+        """load() with the file reads off the event loop"""
+        loaded = await asyncio.to_thread(self.read)
+        if loaded is None:
+            return False
+        self.apply(loaded)
+        return True
+
+    def vectors(self, texts: List[str]) -> np.ndarray:
+        rows = SparseRows.from_counts([feature_counts(text) for text in texts], self.idf)
+        return np.stack([rows.dense(i) for i in range(len(rows))]) if texts else np.zeros((0, SIMILARITY_FEATURES), np.float32)
+
+    def ref(self, kind: str, row_id: str) -> Optional[Dict[str, Any]]:
+        number = self.row_numbers.get((kind, row_id))
+        return None if number is None else self._row(number)["ref"]
+
+    def row_vector(self, kind: str, row_id: str) -> Optional[np.ndarray]:
+        number = self.row_numbers.get((kind, row_id))
+        if number is None:
+            return None
+        if number < len(self.base):
+            return self.base.dense(number)
+        return self.pending.dense(number - len(self.base))
+
+    def top_k(self, queries: np.ndarray, kind: str, limit: int, exclude: Optional[List[tuple]] = None,
+              owner: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """Best matches of one kind for each query vector, by cosine similarity"""
+        scores = np.hstack([self.base.dot(queries), self.pending.dot(queries)])
+        mask = self.kinds == SIMILARITY_KINDS.index(kind)
+        if owner is not None:
+            mask &= self.owners == owner
+        scores[:, ~mask] = 0
+        for key in exclude or []:
+            if key in self.row_numbers:
+                scores[:, self.row_numbers[key]] = 0
+        results = []
+        for row_scores in scores:
+            limit = min(limit, len(row_scores))
+            best = np.argpartition(-row_scores, limit - 1)[:limit] if limit else []
+            results.append([
+                {**self._row(i)["ref"], "score": round(float(row_scores[i]), 4)}
+                for i in sorted(best, key=lambda i: -row_scores[i]) if row_scores[i] > 0
+            ])
+        return results
+
+similarity_index = SimilarityIndex(SIMILARITY_INDEX_DIR)
+similarity_flush: Optional[asyncio.Task] = None
+
+def schedule_similarity_flush():
+    """Write out appended questions in the background; at most one flush runs at a time"""
+    global similarity_flush
+    if similarity_flush is None or similarity_flush.done():
+        similarity_flush = asyncio.create_task(similarity_index.flush())
+
+PREMIUM_TOPICS = {
+    "split-dollar": "Advanced Module 6",
+    "installment sales": "Advanced Module 7", 
+    "qsbs": "Advanced Module 8",
+    "estate planning": "Advanced Module 9",
+    "international": "Advanced Module 10"
+}
+
+class MessageAnalysis(BaseModel):
+    terms: List[str] = []
+    modules: List[str] = []
+    lessons: List[Dict[str, Any]] = []
+    locked_topics: List[str] = []
+    intents: List[str] = []
+
+class MessageAnalyzer:
+    """Every keyword table compiled into one automaton, so a message is scanned once.
+
+    Results keep the order in which matches first appear in the message.
+    Lesson keywords only match whole words, so "str" does not link the
+    short-term rental lesson to every "strategy".
+    """
+
+    def __init__(self, glossary_terms: List[str], lesson_keywords: Dict[str, List[Dict[str, Any]]],
+                 premium_topics: Dict[str, str], intent_keywords: Dict[str, List[str]]):
+        self.automaton = KeywordAutomaton()
+        for term in glossary_terms:
+            self.automaton.add(term.lower(), ("terms", [term]))
+        for keyword, lessons in lesson_keywords.items():
+            self.automaton.add(keyword, ("lessons", lessons))
+        for topic, module in premium_topics.items():
+            self.automaton.add(topic.replace("-", " "), ("locked_topics", [module]))
+        for intent, keywords in intent_keywords.items():
+            for keyword in keywords:
+                self.automaton.add(keyword, ("intents", [intent]))
+        self.automaton.build()
+
+    def analyze(self, message: str) -> MessageAnalysis:
+        text = message.lower()
+        found: Dict[str, Dict[str, Any]] = {"terms": {}, "lessons": {}, "locked_topics": {}, "intents": {}}
+        for start, end, (kind, values) in self.automaton.findall(text):
+            if kind == "lessons":
+                if is_whole_word(text, start, end):
+                    for lesson in values:
+                        found["lessons"].setdefault(lesson["lesson_id"], lesson)
+                continue
+            for value in values:
+                found[kind][value] = value
+        lessons = list(found.pop("lessons").values())
+        return MessageAnalysis(
+            modules=list(dict.fromkeys(lesson["label"] for lesson in lessons)),
+            lessons=lessons,
+            **{kind: list(values) for kind, values in found.items()}
+        )
 
-**Example:** {strategy['example']}
+def build_message_analyzer() -> MessageAnalyzer:
+    return MessageAnalyzer(GLOSSARY_DETECTION_TERMS, module_index.keywords, PREMIUM_TOPICS, QGPT_INTENT_KEYWORDS)
 
-**Next Step:** {strategy['next_step']}"""
-        
-        return response
-    
-    return "I need more context to give you a strategic answer. What specific tax challenge are you trying to solve?"
+message_analyzer = build_message_analyzer()
 
-def detect_glossary_terms(message: str) -> List[str]:
-    """Detect glossary terms mentioned in user message"""
-    glossary_terms = [
-        "REPS", "Real Estate Professional Status", "QBI", "Cost Segregation", 
-        "W-2 Income", "Depreciation", "QOF", "Qualified Opportunity Fund",
-        "Short-Term Rental", "STR", "Material Participation", "Bonus Depreciation",
-        "Offset Stacking", "Repositioning", "Effective Tax Rate", "Forward-Looking Planning"
+def question_document(message: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "kind": "question",
+        "id": message["id"],
+        "owner": message["user_id"],
+        "text": message["message"],
+        "ref": {
+            "message_id": message["id"],
+            "thread_id": message["thread_id"],
+            "question": message["message"][:200],
+            "timestamp": message["timestamp"].isoformat()
+        }
+    }
+
+async def question_document_batches(since: Optional[datetime]):
+    """Chat questions stored after `since`, oldest first, in batches; each with the newest timestamp so far"""
+    query = {"timestamp": {"$gt": since}} if since else {}
+    documents = []
+    async for message in db.chat_messages.find(
+        query, {"_id": 0, "id": 1, "user_id": 1, "thread_id": 1, "message": 1, "timestamp": 1},
+        batch_size=SIMILARITY_FIT_BATCH
+    ).sort("timestamp", 1):
+        documents.append(question_document(message))
+        if len(documents) >= SIMILARITY_FIT_BATCH:
+            yield documents, message["timestamp"]
+            documents = []
+    if documents:
+        yield documents, message["timestamp"]
+
+def fit_similarity_index(fitting: SimilarityFit, fingerprint: str, last_question_at: Optional[datetime]) -> SimilarityIndex:
+    index = SimilarityIndex(SIMILARITY_INDEX_DIR)
+    index.fit(fitting, fingerprint, last_question_at)
+    index.save()
+    return index
+
+async def refresh_similarity_index(courses: List[Dict[str, Any]], glossary: List[Dict[str, Any]], rebuild: bool = False):
+    """Refit when lessons or glossary changed, otherwise append questions stored since the last refresh"""
+    global similarity_index
+    if similarity_flush is not None:
+        # A flush of the index about to be refit or reloaded must not land afterwards
+        await asyncio.gather(similarity_flush, return_exceptions=True)
+    await similarity_index.reload()
+    documents = [
+        {"kind": "lesson", "id": lesson["id"], "text": f"{lesson['title']}\n{lesson.get('content', '')}",
+         "ref": lesson_ref(course, lesson)}
+        for course in courses for lesson in course.get("lessons", [])
+    ] + [
+        {"kind": "glossary", "id": term["id"], "text": f"{term['term']}\n{term['definition']}",
+         "ref": {"id": term["id"], "term": term["term"], "category": term["category"]}}
+        for term in glossary
     ]
+    fingerprint = hashlib.sha1(json.dumps([[d["kind"], d["id"], d["text"]] for d in documents]).encode()).hexdigest()
+    if rebuild or not similarity_index.ready or similarity_index.fingerprint != fingerprint:
+        # Vectorizing every lesson takes a while; keep serving from the old index meanwhile
+        fitting = SimilarityFit()
+        await asyncio.to_thread(fitting.add, documents)
+        last_question_at = None
+        async for questions, last_question_at in question_document_batches(None):
+            await asyncio.to_thread(fitting.add, questions)
+        similarity_index = await asyncio.to_thread(fit_similarity_index, fitting, fingerprint, last_question_at)
+        return
+    since = similarity_index.last_question_at
+    latest = None
+    async for questions, latest in question_document_batches(
+        since - timedelta(seconds=SIMILARITY_QUESTION_GRACE_SECONDS) if since else None
+    ):
+        similarity_index.append(questions)
+    # Never move backwards: the grace window re-reads questions already covered
+    similarity_index.last_question_at = max(filter(None, [since, latest]), default=None)
+    if similarity_index.pending_rows:
+        await similarity_index.flush()
+
+async def refresh_course_indexes(rebuild_similarity: bool = False) -> bool:
+    """Resync the module keyword, passage and similarity indexes with stored courses.
+
+    The analyzer is rebuilt only if keyword links changed.
+    """
+    global message_analyzer
+    courses = await db.courses.find({}, {
+        "_id": 0, "id": 1, "title": 1, "is_free": 1,
+        "lessons.id": 1, "lessons.title": 1, "lessons.content": 1, "lessons.order_index": 1
+    }).to_list(None)
+    glossary = await db.glossary.find({}, {"_id": 0, "id": 1, "term": 1, "definition": 1, "category": 1}).to_list(None)
+    await refresh_similarity_index(courses, glossary, rebuild_similarity)
+    passages_changed = passage_index.sync(courses)
+    if passages_changed:
+        clear_qgpt_cache()
+    if not module_index.sync(courses, [g["term"] for g in glossary]):
+        return passages_changed
+    message_analyzer = build_message_analyzer()
+    return True
+
+async def refresh_course_indexes_periodically():
+    # Picks up course edits made through other workers
+    while True:
+        await asyncio.sleep(COURSE_INDEX_REFRESH_SECONDS)
+        try:
+            await refresh_course_indexes()
+        except Exception:
+            logger.exception("Course index refresh failed")
+
+MAX_SIMILAR_RESULTS = 20
+MAX_SIMILARITY_BATCH = 32
+
+class SimilarityQuery(BaseModel):
+    texts: List[str]
+    kind: str = "lesson"  # "lesson" or "glossary"
+    limit: int = 5
+
+def similar_to_row(kind: str, row_id: str, limit: int) -> List[Dict[str, Any]]:
+    if not similarity_index.ready:
+        raise HTTPException(status_code=503, detail="Similarity index is not built yet")
+    vector = similarity_index.row_vector(kind, row_id)
+    if vector is None:
+        raise HTTPException(status_code=404, detail=f"{kind.capitalize()} not found")
+    limit = max(1, min(limit, MAX_SIMILAR_RESULTS))
+    return similarity_index.top_k(vector[None, :], kind, limit, exclude=[(kind, row_id)])[0]
+
+@api_router.get("/courses/{course_id}/lessons/{lesson_id}/related")
+async def get_related_lessons(course_id: str, lesson_id: str, limit: int = 5):
+    ref = similarity_index.ref("lesson", lesson_id)
+    if ref and ref["course_id"] != course_id:
+        raise HTTPException(status_code=404, detail="Lesson not found")
+    return similar_to_row("lesson", lesson_id, limit)
+
+@api_router.get("/glossary/{term_id}/related")
+async def get_related_terms(term_id: str, limit: int = 5):
+    return similar_to_row("glossary", term_id, limit)
+
+@api_router.get("/users/{user_id}/similar-questions")
+async def get_similar_questions(user_id: str, q: str, limit: int = 5):
+    """The user's own past questions closest to `q`"""
+    if not similarity_index.ready:
+        raise HTTPException(status_code=503, detail="Similarity index is not built yet")
+    limit = max(1, min(limit, MAX_SIMILAR_RESULTS))
+    return similarity_index.top_k(similarity_index.vectors([q]), "question", limit, owner=user_id)[0]
+
+@api_router.post("/similarity/query")
+async def query_similarity(query: SimilarityQuery):
+    """Batch top-k lookup of lessons or glossary terms for several texts at once"""
+    if query.kind not in ("lesson", "glossary"):
+        raise HTTPException(status_code=400, detail="kind must be 'lesson' or 'glossary'")
+    if not 0 < len(query.texts) <= MAX_SIMILARITY_BATCH:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {MAX_SIMILARITY_BATCH} texts")
+    if not similarity_index.ready:
+        raise HTTPException(status_code=503, detail="Similarity index is not built yet")
+    limit = max(1, min(query.limit, MAX_SIMILAR_RESULTS))
+    return {"results": similarity_index.top_k(similarity_index.vectors(query.texts), query.kind, limit)}
+
+@api_router.post("/admin/similarity/rebuild")
+async def rebuild_similarity_index():
+    await refresh_course_indexes(rebuild_similarity=True)
+    return {"version": similarity_index.version, "rows": len(similarity_index.row_numbers)}
+
+QGPT_INTENT_PRIORITY = {intent: rank for rank, intent in enumerate(QGPT_INTENT_KEYWORDS)}
+# Fully formatted once at import; routing a message is then a dict lookup
+QGPT_RESPONSES = {
+    **{intent: QGPT_STRATEGY_TEMPLATE.format(**strategy) for intent, strategy in QGPT_STRATEGIES.items()},
+    "help": QGPT_HELP_RESPONSE
+}
+
+def route_qgpt_intent(intents: List[str]) -> Optional[str]:
+    """Highest-priority answerable intent; "premium_topic" only gates access"""
+    routable = [intent for intent in intents if intent != "premium_topic"]
+    return min(routable, key=QGPT_INTENT_PRIORITY.__getitem__) if routable else None
+
+def generate_qgpt_response(message: str, has_full_access: bool, has_subscription: bool, terms: List[str], modules: List[str],
+                           intents: Optional[List[str]] = None, passages: Optional[List[Dict[str, Any]]] = None) -> str:
+    """Generate QGPT responses following Quantus Group behavior model"""
+    # Handle gated content
+    if not has_subscription:
+        return QGPT_SUBSCRIPTION_REQUIRED
     
-    detected = []
-    message_lower = message.lower()
+    if intents is None:
+        intents = message_analyzer.analyze(message).intents
+    if not has_full_access and "premium_topic" in intents:
+        return QGPT_PREMIUM_REQUIRED
     
-    for term in glossary_terms:
-        if term.lower() in message_lower:
-            detected.append(term)
+    intent = route_qgpt_intent(intents)
+    if intent:
+        return QGPT_RESPONSES[intent]
     
-    return list(set(detected))
+    # Generic strategic response, pointing at the closest lesson passage when there is one.
+    # Cached answers are shared by every wording of a question, so echo the normalized form.
+    response = QGPT_FALLBACK_TEMPLATE.format(
+        message=normalize_question(message)[:50],
+        related=', '.join(terms) if terms else 'General tax strategy'
+    )
+    if passages:
+        response += QGPT_PASSAGE_TEMPLATE.format(**passages[0])
+    return response
+
+def detect_glossary_terms(message: str) -> List[str]:
+    """Detect glossary terms mentioned in user message"""
+    return message_analyzer.analyze(message).terms
 
 def detect_related_modules(message: str) -> List[str]:
     """Detect related course modules based on message content"""
-    module_keywords = {
-        "reps": ["W-2 Escape Plan - Module 4"],
-        "real estate professional": ["W-2 Escape Plan - Module 4"],
-        "offset stacking": ["W-2 Escape Plan - Module 3"],
-        "repositioning": ["W-2 Escape Plan - Module 2"],
-        "w-2 income": ["W-2 Escape Plan - Module 1"],
-        "cost segregation": ["W-2 Escape Plan - Module 3"],
-        "qof": ["W-2 Escape Plan - Module 2"],
-        "opportunity fund": ["W-2 Escape Plan - Module 2"],
-        "short-term rental": ["W-2 Escape Plan - Module 2"],
-        "str": ["W-2 Escape Plan - Module 2"]
-    }
-    
-    related = []
-    message_lower = message.lower()
-    
-    for keyword, modules in module_keywords.items():
-        if keyword in message_lower:
-            related.extend(modules)
-    
-    return list(set(related))
+    return message_analyzer.analyze(message).modules
 
 def check_locked_topics(message: str, user_progress: List[UserProgress]) -> List[str]:
     """Check if user is asking about locked premium topics"""
-    premium_topics = {
-        "split-dollar": "Advanced Module 6",
-        "installment sales": "Advanced Module 7", 
-        "qsbs": "Advanced Module 8",
-        "estate planning": "Advanced Module 9",
-        "international": "Advanced Module 10"
-    }
-    
-    locked = []
-    message_lower = message.lower()
-    
-    for topic, module in premium_topics.items():
-        if topic.replace("-", " ") in message_lower:
-            locked.append(module)
-    
-    return locked
-@api_router.post("/progress")
-async def update_progress(progress: UserProgress):
-    existing = await db.user_progress.find_one({
-        "user_id": progress.user_id,
-        "course_id": progress.course_id,
-        "lesson_id": progress.lesson_id
-    })
-    
-    if existing:
-        await db.user_progress.update_one(
-            {"id": existing["id"]},
-            {"$set": progress.dict()}
-        )
-    else:
-        await db.user_progress.insert_one(progress.dict())
-    
-    return {"status": "success"}
-
-@api_router.get("/progress/{user_id}")
-async def get_user_progress(user_id: str):
-    progress = await db.user_progress.find({"user_id": user_id}).to_list(1000)
-    return [UserProgress(**p) for p in progress]
+    return message_analyzer.analyze(message).locked_topics
 
 # Initialize sample data
 @api_router.post("/initialize-data")
 async def initialize_sample_data():
     # Clear existing data
     await db.courses.delete_many({})
+    course_lesson_counts.clear()
     await db.quiz_questions.delete_many({})
     await db.glossary.delete_many({})
     await db.tools.delete_many({})
     await db.marketplace.delete_many({})
     await db.user_xp.delete_many({})
+    await db.user_xp_weekly.delete_many({})
+    await db.xp_events.delete_many({})
+    await db.glossary_xp_awards.delete_many({})
+    glossary_xp_seen.clear()
+    reset_leaderboards()
     await db.chat_threads.delete_many({})
+    await db.chat_messages.delete_many({})
+    await db.starred_messages.delete_many({})
     await db.user_subscriptions.delete_many({})
+    chat_context_cache.clear()
+    clear_qgpt_cache()
     
     # Sample courses
     primer_course = Course(
@@ -6509,6 +9044,7 @@ Understanding these terms is essential for legacy structuring mastery:
         subscription_tier="premium"
     )
     await db.user_subscriptions.insert_one(default_subscription.dict())
+    await refresh_course_indexes()
     
     return {"status": "Sample data initialized successfully"}
 
@@ -6535,6 +9071,70 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def ensure_unique_index(collection, keys: List[tuple], keep_first: List[tuple]) -> int:
+    """Create a unique index, first dropping duplicates left by older non-atomic writes.
+
+    Of each group of duplicates the document sorting first by keep_first is
+    kept. Returns how many documents were removed.
+    """
+    try:
+        await collection.create_index(keys, unique=True)
+        return 0
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+    removed = 0
+    async for group in collection.aggregate([
+        {"$sort": dict(keep_first)},
+        {"$group": {"_id": {field: f"${field}" for field, _ in keys}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True):
+        result = await collection.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+    logger.warning(f"Removed {removed} duplicate documents from {collection.name} before indexing")
+    await collection.create_index(keys, unique=True)
+    return removed
+
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_unique_index(db.user_xp, [("user_id", 1)], keep_first=[("total_xp", -1)])
+    await ensure_unique_index(
+        db.user_subscriptions, [("user_id", 1)],
+        keep_first=[("has_active_subscription", -1), ("created_at", -1)]
+    )
+    removed_progress = await ensure_unique_index(
+        db.user_progress, [(field, 1) for field in PROGRESS_KEY_FIELDS],
+        keep_first=[("completed", -1), ("completed_at", -1)]
+    )
+    await db.course_progress_summaries.create_index([("user_id", 1), ("course_id", 1)], unique=True)
+    if removed_progress:
+        # Existing summaries may have counted the duplicates just removed
+        await refresh_course_summaries({})
+    else:
+        await backfill_course_summaries()
+    await db.chat_threads.create_index([("user_id", 1), ("last_updated", -1), ("id", -1)])
+    await db.chat_messages.create_index([("thread_id", 1), ("timestamp", -1), ("id", -1)])
+    await db.chat_messages.create_index([("thread_id", 1), ("id", 1)], unique=True)
+    await db.chat_messages.create_index([("user_id", 1), ("message", "text"), ("response", "text")])
+    await db.chat_messages.create_index([("timestamp", 1)])
+    await db.chat_messages.create_index([("is_starred", 1)], partialFilterExpression={"is_starred": True})
+    await db.starred_messages.create_index([("user_id", 1), ("id", 1)], unique=True)
+    await db.starred_messages.create_index([("user_id", 1), ("starred_at", -1), ("id", -1)])
+    await migrate_embedded_chat_messages()
+    await backfill_starred_messages()
+    await db.glossary_xp_awards.create_index([("user_id", 1), ("term_id", 1)], unique=True)
+    await db.user_xp.create_index([("total_xp", -1)])
+    await db.user_xp_weekly.create_index([("week", 1), ("user_id", 1)], unique=True)
+    await db.user_xp_weekly.create_index([("week", 1), ("xp", -1)])
+    await db.xp_events.create_index([("id", 1)], unique=True)
+    await db.xp_events.create_index([("user_id", 1), ("created_at", -1)])
+    if XP_COMPACTION_INTERVAL_SECONDS > 0:
+        asyncio.create_task(compact_xp_ledger_periodically())
+    await refresh_course_indexes()
+    if COURSE_INDEX_REFRESH_SECONDS > 0:
+        asyncio.create_task(refresh_course_indexes_periodically())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await generation_pool.stop()
     client.close()
@@ -53,39 +53,127 @@ const TaxBotSection = () => {
   const [isLoading, setIsLoading] = useState(false);
   const [searchQuery, setSearchQuery] = useState('');
   const [filteredThreads, setFilteredThreads] = useState([]);
+  const [messageMatches, setMessageMatches] = useState([]);
+  const [olderMessagesCursor, setOlderMessagesCursor] = useState(null);
+  const [olderThreadsCursor, setOlderThreadsCursor] = useState(null);
+  const [isLoadingOlder, setIsLoadingOlder] = useState(false);
 
   useEffect(() => {
     loadChatThreads();
   }, []);
 
   useEffect(() => {
-    if (searchQuery) {
-      const filtered = chatThreads.filter(thread => 
-        thread.title.toLowerCase().includes(searchQuery.toLowerCase()) ||
-        thread.messages.some(msg => 
-          msg.message.toLowerCase().includes(searchQuery.toLowerCase()) ||
-          msg.response.toLowerCase().includes(searchQuery.toLowerCase())
-        )
-      );
-      setFilteredThreads(filtered);
-    } else {
+    if (!searchQuery.trim()) {
       setFilteredThreads(chatThreads);
+      setMessageMatches([]);
+      return;
     }
+
+    // Threads only embed their latest messages, so history is searched on the server
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const response = await fetch(
+          `${process.env.REACT_APP_BACKEND_URL}/api/users/default_user/chat-threads/search?query=${encodeURIComponent(searchQuery)}`
+        );
+        if (!response.ok || cancelled) return;
+        const found = await response.json();
+        if (cancelled) return;
+        const threadIds = new Set([
+          ...found.results.map(result => result.thread_id),
+          ...(found.threads || []).map(thread => thread.id)
+        ]);
+        // Hits may be in threads the sidebar has not paged in yet
+        const threadsById = new Map(chatThreads.map(thread => [thread.id, thread]));
+        (found.threads || []).forEach(thread => threadsById.has(thread.id) || threadsById.set(thread.id, thread));
+        found.results.forEach(result => threadsById.has(result.thread_id) || threadsById.set(result.thread_id, {
+          id: result.thread_id, title: result.thread_title, last_updated: result.timestamp
+        }));
+        setFilteredThreads([...threadIds].map(id => threadsById.get(id)));
+        setMessageMatches(found.results);
+      } catch (error) {
+        console.error('Failed to search conversations:', error);
+      }
+    }, 300);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
   }, [searchQuery, chatThreads]);
 
-  const loadChatThreads = async () => {
+  // The sidebar pages through thread summaries; messages are loaded when a thread is opened
+  const loadChatThreads = async (before = null) => {
     try {
-      const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/api/users/default_user/chat-threads`);
+      const params = before ? `?before=${encodeURIComponent(before)}` : '';
+      const response = await fetch(
+        `${process.env.REACT_APP_BACKEND_URL}/api/users/default_user/chat-threads/list${params}`
+      );
       if (response.ok) {
-        const threads = await response.json();
-        setChatThreads(threads);
-        setFilteredThreads(threads);
+        const page = await response.json();
+        setChatThreads(threads => before ? [...threads, ...page.threads] : page.threads);
+        setOlderThreadsCursor(page.next_cursor);
       }
     } catch (error) {
       console.error('Failed to load chat threads:', error);
     }
   };
 
+  // Threads only embed their latest messages; the rest are paged in from the messages endpoint
+  const fetchMessagesPage = async (threadId, before) => {
+    const params = before ? `?before=${encodeURIComponent(before)}` : '';
+    const response = await fetch(
+      `${process.env.REACT_APP_BACKEND_URL}/api/users/default_user/chat-threads/${threadId}/messages${params}`
+    );
+    return response.ok ? response.json() : null;
+  };
+
+  const openThread = async (thread) => {
+    const messages = thread.messages || [];
+    setCurrentThread({ ...thread, messages });
+    setOlderMessagesCursor(null);
+    if (thread.messages && thread.message_count <= messages.length) return;
+
+    try {
+      const page = await fetchMessagesPage(thread.id);
+      if (page) {
+        setCurrentThread(current => current?.id === thread.id ? { ...current, messages: page.messages } : current);
+        setOlderMessagesCursor(page.next_cursor);
+      }
+    } catch (error) {
+      console.error('Failed to load messages:', error);
+    }
+  };
+
+  const loadOlderMessages = async () => {
+    if (!currentThread || !olderMessagesCursor) return;
+
+    setIsLoadingOlder(true);
+    try {
+      const threadId = currentThread.id;
+      const page = await fetchMessagesPage(threadId, olderMessagesCursor);
+      if (page) {
+        setCurrentThread(current => current?.id === threadId
+          ? { ...current, messages: [...page.messages, ...current.messages] }
+          : current);
+        setOlderMessagesCursor(page.next_cursor);
+      }
+    } catch (error) {
+      console.error('Failed to load older messages:', error);
+    } finally {
+      setIsLoadingOlder(false);
+    }
+  };
+
+  const openSearchMatch = (match) => {
+    const thread = chatThreads.find(t => t.id === match.thread_id);
+    openThread(thread || { id: match.thread_id, title: match.thread_title });
+  };
+
+  // Search snippets mark matched words with **
+  const renderSnippet = (snippet) => snippet.split('**').map((part, idx) =>
+    idx % 2 ? <strong key={idx}>{part}</strong> : <span key={idx}>{part}</span>
+  );
+
   const createNewThread = async () => {
     const newThread = {
       id: Date.now().toString(),
@@ -106,8 +194,11 @@ const TaxBotSection = () => {
 
       if (response.ok) {
         const thread = await response.json();
-        setChatThreads([thread, ...chatThreads]);
+        // The sidebar holds summaries only, so reopening a thread always loads its messages
+        const { messages, ...summary } = thread;
+        setChatThreads([summary, ...chatThreads]);
         setCurrentThread(thread);
+        setOlderMessagesCursor(null);
       }
     } catch (error) {
       console.error('Failed to create thread:', error);
@@ -141,16 +232,19 @@ const TaxBotSection = () => {
 
       if (response.ok) {
         const updatedMessage = await response.json();
-        const updatedThread = {
+        const lastUpdated = new Date().toISOString();
+        setCurrentThread({
           ...currentThread,
           messages: [...currentThread.messages, updatedMessage],
-          last_updated: new Date().toISOString()
-        };
-        setCurrentThread(updatedThread);
+          message_count: (currentThread.message_count || 0) + 1,
+          last_updated: lastUpdated
+        });
         
-        // Update threads list
+        // Update the thread's summary in the sidebar
         setChatThreads(threads => 
-          threads.map(t => t.id === currentThread.id ? updatedThread : t)
+          threads.map(t => t.id === currentThread.id
+            ? { ...t, last_updated: lastUpdated, last_message_preview: updatedMessage.message }
+            : t)
         );
         
         setNewMessage('');
@@ -265,7 +359,7 @@ const TaxBotSection = () => {
               {filteredThreads.map((thread) => (
                 <div
                   key={thread.id}
-                  onClick={() => setCurrentThread(thread)}
+                  onClick={() => openThread(thread)}
                   className={`p-3 rounded-lg cursor-pointer transition-colors ${
                     currentThread?.id === thread.id
                       ? 'bg-emerald-100 border-emerald-500 border'
@@ -288,6 +382,33 @@ const TaxBotSection = () => {
                 </div>
               ))}
             </div>
+            {olderThreadsCursor && !searchQuery.trim() && (
+              <button
+                onClick={() => loadChatThreads(olderThreadsCursor)}
+                className="w-full mt-2 text-sm text-blue-600 hover:text-blue-800"
+              >
+                Show older conversations
+              </button>
+            )}
+
+            {/* Matching Messages */}
+            {messageMatches.length > 0 && (
+              <div className="mt-4 space-y-2">
+                <h3 className="text-xs font-semibold text-gray-500 uppercase">Matching messages</h3>
+                {messageMatches.map((match) => (
+                  <div
+                    key={match.message_id}
+                    onClick={() => openSearchMatch(match)}
+                    className="p-3 rounded-lg cursor-pointer bg-gray-50 hover:bg-gray-100 transition-colors"
+                  >
+                    <p className="font-medium text-xs text-navy-900 truncate">{match.thread_title}</p>
+                    <p className="text-xs text-gray-600 mt-1">
+                      {renderSnippet(match.message_snippet || match.response_snippet || '')}
+                    </p>
+                  </div>
+                ))}
+              </div>
+            )}
           </div>
 
           {/* Chat Interface */}
@@ -323,6 +444,17 @@ const TaxBotSection = () => {
 
                 {/* Messages */}
                 <div className="flex-1 overflow-y-auto p-4 space-y-4">
+                  {olderMessagesCursor && (
+                    <div className="flex justify-center">
+                      <button
+                        onClick={loadOlderMessages}
+                        disabled={isLoadingOlder}
+                        className="text-sm text-blue-600 hover:text-blue-800 disabled:opacity-50"
+                      >
+                        {isLoadingOlder ? 'Loading...' : 'Load earlier messages'}
+                      </button>
+                    </div>
+                  )}
                   {currentThread.messages.map((message) => (
                     <div key={message.id} className="space-y-4">
                       {/* User Message */}
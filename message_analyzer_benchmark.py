@@ -0,0 +1,111 @@
+"""Benchmark the single-pass MessageAnalyzer against the separate keyword scans it replaced.
+
+Run from the repository root with the backend requirements installed:
+
+    python message_analyzer_benchmark.py
+
+Importing the backend only needs MONGO_URL and DB_NAME (read from
+backend/.env); no database connection is made.
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import server  # noqa: E402
+
+# The hard-coded module table the analyzer used before links were derived from course content
+LEGACY_MODULE_KEYWORDS = {
+    "reps": ["W-2 Escape Plan - Module 4"],
+    "real estate professional": ["W-2 Escape Plan - Module 4"],
+    "offset stacking": ["W-2 Escape Plan - Module 3"],
+    "repositioning": ["W-2 Escape Plan - Module 2"],
+    "w-2 income": ["W-2 Escape Plan - Module 1"],
+    "cost segregation": ["W-2 Escape Plan - Module 3"],
+    "qof": ["W-2 Escape Plan - Module 2"],
+    "opportunity fund": ["W-2 Escape Plan - Module 2"],
+    "short-term rental": ["W-2 Escape Plan - Module 2"],
+    "str": ["W-2 Escape Plan - Module 2"]
+}
+
+# Same shape as ModuleKeywordIndex.keywords
+LESSON_KEYWORDS = {
+    keyword: [{"course_id": "w2", "lesson_id": label, "title": label, "label": label} for label in labels]
+    for keyword, labels in LEGACY_MODULE_KEYWORDS.items()
+}
+
+# The scans as they were before MessageAnalyzer: one lowercase and one pass per table
+def legacy_detect_glossary_terms(message):
+    message_lower = message.lower()
+    return list(set(term for term in server.GLOSSARY_DETECTION_TERMS if term.lower() in message_lower))
+
+def legacy_detect_related_modules(message):
+    message_lower = message.lower()
+    related = []
+    for keyword, modules in LEGACY_MODULE_KEYWORDS.items():
+        if keyword in message_lower:
+            related.extend(modules)
+    return list(set(related))
+
+def legacy_check_locked_topics(message):
+    message_lower = message.lower()
+    return [module for topic, module in server.PREMIUM_TOPICS.items() if topic.replace("-", " ") in message_lower]
+
+def legacy_intents(message, intent_keywords):
+    message_lower = message.lower()
+    return [intent for intent, keywords in intent_keywords.items() if any(k in message_lower for k in keywords)]
+
+def legacy_analyze(message, intent_keywords):
+    return (
+        legacy_detect_glossary_terms(message),
+        legacy_detect_related_modules(message),
+        legacy_check_locked_topics(message),
+        legacy_intents(message, intent_keywords),
+    )
+
+SAMPLE_MESSAGES = [
+    "How do I qualify for REPS if I work a full-time W-2 job?",
+    "Can cost segregation on a short-term rental offset my W-2 income?",
+    "What's the difference between a QOF and an opportunity zone fund?",
+    "Help me get started with offset stacking and bonus depreciation",
+    "Is split dollar life insurance or installment sales better for estate planning?",
+    "What is my effective tax rate after repositioning RSU gains?",
+    "Tell me about international tax strategies for a QSBS exit",
+    "hello",
+]
+
+def synthetic_intents(count):
+    """QGPT_INTENT_KEYWORDS plus `count` made-up strategies, to show how cost scales"""
+    rules = dict(server.QGPT_INTENT_KEYWORDS)
+    rng = random.Random(42)
+    for i in range(count):
+        rules[f"strategy_{i}"] = [f"{rng.choice(['dual', 'augusta', 'captive', 'solo'])} plan {i}", f"keyword{i}"]
+    return rules
+
+def check_equivalence(analyzer, intent_keywords):
+    # Modules are not compared: lesson keywords now match whole words only,
+    # so "str" no longer links a message that merely says "strategies"
+    for message in SAMPLE_MESSAGES:
+        analysis = analyzer.analyze(message)
+        terms, _, locked, intents = legacy_analyze(message, intent_keywords)
+        assert set(analysis.terms) == set(terms), message
+        assert set(analysis.locked_topics) == set(locked), message
+        assert set(analysis.intents) == set(intents), message
+
+def run(label, intent_keywords, iterations=2000):
+    analyzer = server.MessageAnalyzer(
+        server.GLOSSARY_DETECTION_TERMS, LESSON_KEYWORDS, server.PREMIUM_TOPICS, intent_keywords
+    )
+    check_equivalence(analyzer, intent_keywords)
+    calls = iterations * len(SAMPLE_MESSAGES)
+    legacy = timeit.timeit(lambda: [legacy_analyze(m, intent_keywords) for m in SAMPLE_MESSAGES], number=iterations)
+    single = timeit.timeit(lambda: [analyzer.analyze(m) for m in SAMPLE_MESSAGES], number=iterations)
+    print(f"{label:<28} legacy {legacy / calls * 1e6:7.1f} us/msg   "
+          f"analyzer {single / calls * 1e6:7.1f} us/msg   speedup {legacy / single:4.1f}x")
+
+if __name__ == "__main__":
+    run("current keyword tables", server.QGPT_INTENT_KEYWORDS)
+    run("with 50 extra strategies", synthetic_intents(50))
+    run("with 500 extra strategies", synthetic_intents(500))
@@ -0,0 +1,68 @@
+"""Shared fixtures: the app runs in-process against an in-memory Motor mock.
+
+    pip install -r backend/requirements.txt
+    python -m pytest -q tests
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import server  # noqa: E402
+
+USER_ID = "smoke_user"
+
+
+async def create_unique_indexes(db):
+    """The unique indexes startup creates; idempotency and dedup rely on them"""
+    await db.user_xp.create_index([("user_id", 1)], unique=True)
+    await db.user_subscriptions.create_index([("user_id", 1)], unique=True)
+    await db.user_progress.create_index([(field, 1) for field in server.PROGRESS_KEY_FIELDS], unique=True)
+    await db.course_progress_summaries.create_index([("user_id", 1), ("course_id", 1)], unique=True)
+    await db.chat_messages.create_index([("thread_id", 1), ("id", 1)], unique=True)
+    await db.starred_messages.create_index([("user_id", 1), ("id", 1)], unique=True)
+    await db.glossary_xp_awards.create_index([("user_id", 1), ("term_id", 1)], unique=True)
+    await db.user_xp_weekly.create_index([("week", 1), ("user_id", 1)], unique=True)
+    await db.xp_events.create_index([("id", 1)], unique=True)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh mock database with the unique indexes in place, installed as server.db"""
+    database = mongomock_motor.AsyncMongoMockClient()["test"]
+    asyncio.run(create_unique_indexes(database))
+    monkeypatch.setattr(server, "db", database)
+    server.glossary_xp_seen.clear()
+    server.chat_context_cache.clear()
+    return database
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    """TestClient for the app, with an all-access subscription for USER_ID"""
+    # Startup builds indexes and runs migrations the mock does not support
+    monkeypatch.setattr(server.app.router, "on_startup", [])
+    monkeypatch.setattr(server.app.router, "on_shutdown", [])
+    monkeypatch.setattr(server, "generation_pool", server.GenerationPool(
+        server.TemplateBackend(), server.QGPT_CONCURRENCY, server.QGPT_QUEUE_SIZE, server.QGPT_TIMEOUT_SECONDS
+    ))
+    server.clear_qgpt_cache()
+    with TestClient(server.app) as test_client:
+        response = test_client.post(f"/api/users/{USER_ID}/subscription", json={
+            "user_id": USER_ID, "plan_type": "all_access", "has_active_subscription": True
+        })
+        assert response.status_code == 200
+        yield test_client
+
+
+def create_thread(client, title="Smoke"):
+    response = client.post(f"/api/users/{USER_ID}/chat-threads", json={"user_id": USER_ID, "title": title})
+    assert response.status_code == 200
+    return response.json()["id"]
@@ -0,0 +1,38 @@
+"""Chat threads and their stored messages."""
+import asyncio
+
+from .conftest import USER_ID, create_thread
+
+
+def post_message(client, thread_id, message_id, text="What is REPS?"):
+    return client.post(f"/api/users/{USER_ID}/chat-threads/{thread_id}/messages", json={
+        "id": message_id, "user_id": USER_ID, "message": text, "response": ""
+    })
+
+
+def test_created_thread_messages_belong_to_path_user(client):
+    response = client.post(f"/api/users/{USER_ID}/chat-threads", json={
+        "user_id": "someone_else", "title": "Imported",
+        "messages": [{"user_id": "someone_else", "message": "What is REPS?", "response": "A status."}]
+    })
+    assert response.status_code == 200
+    thread_id = response.json()["id"]
+    history = client.get(f"/api/users/{USER_ID}/chat-threads/{thread_id}/messages").json()
+    assert [m["user_id"] for m in history["messages"]] == [USER_ID]
+    assert client.get(f"/api/users/someone_else/chat-threads/{thread_id}/messages").status_code == 404
+
+
+def test_repeated_message_id_is_409_and_leaves_thread_unchanged(client, db):
+    thread_id = create_thread(client)
+    assert post_message(client, thread_id, "m1").status_code == 200
+    response = post_message(client, thread_id, "m1", text="Asked again")
+    assert response.status_code == 409
+
+    thread = client.get(f"/api/users/{USER_ID}/chat-threads/{thread_id}").json()
+    assert thread["message_count"] == 1
+    assert [m["id"] for m in thread["messages"]] == ["m1"]
+
+
+def test_message_for_missing_thread_is_404_and_not_stored(client, db):
+    assert post_message(client, "missing", "m1").status_code == 404
+    assert asyncio.run(db.chat_messages.count_documents({"id": "m1"})) == 0
@@ -0,0 +1,182 @@
+"""Smoke tests for the streaming chat endpoints (SSE and WebSocket)."""
+import asyncio
+import json
+
+import server
+from .conftest import USER_ID, create_thread
+
+
+def parse_sse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_sse_stream_sends_context_chunks_and_done(client):
+    thread_id = create_thread(client)
+    response = client.post(
+        f"/api/users/{USER_ID}/chat-threads/{thread_id}/messages/stream",
+        json={"user_id": USER_ID, "message": "How do I qualify for REPS?", "response": ""}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = parse_sse(response.text)
+    kinds = [kind for kind, _ in events]
+    assert kinds[0] == "context"
+    assert kinds[-1] == "done"
+    assert "chunk" in kinds
+    assert "REPS" in events[0][1]["glossary"]
+
+    streamed = "".join(data["text"] for kind, data in events if kind == "chunk")
+    stored = events[-1][1]
+    assert stored["response"] == streamed
+    assert "Real Estate Professional Status" in streamed
+
+    history = client.get(f"/api/users/{USER_ID}/chat-threads/{thread_id}/messages").json()
+    assert [m["id"] for m in history["messages"]] == [stored["id"]]
+
+
+def test_sse_stream_unknown_thread_is_404(client):
+    response = client.post(
+        f"/api/users/{USER_ID}/chat-threads/missing/messages/stream",
+        json={"user_id": USER_ID, "message": "hello", "response": ""}
+    )
+    assert response.status_code == 404
+
+
+def test_websocket_send_message_streams_reply(client):
+    thread_id = create_thread(client)
+    with client.websocket_connect(f"/api/users/{USER_ID}/ws") as ws:
+        ws.send_text(json.dumps({"type": "ping"}))
+        assert ws.receive_json() == {"type": "pong"}
+
+        ws.send_text(json.dumps({
+            "type": "send_message", "thread_id": thread_id, "request_id": "r1",
+            "message": "What is cost segregation?"
+        }))
+        events = []
+        while not events or events[-1]["type"] not in ("message_complete", "error"):
+            events.append(ws.receive_json())
+
+    kinds = [event["type"] for event in events]
+    assert kinds[0] == "message_context"
+    assert kinds[-1] == "message_complete", events[-1]
+    assert "thread_updated" in kinds
+    streamed = "".join(event["text"] for event in events if event["type"] == "chunk")
+    assert events[-1]["message"]["response"] == streamed
+    assert "Cost Segregation" in streamed
+
+
+def test_websocket_rejects_invalid_json(client):
+    with client.websocket_connect(f"/api/users/{USER_ID}/ws") as ws:
+        ws.send_text("not json")
+        assert ws.receive_json() == {"type": "error", "detail": "Invalid JSON event"}
+        ws.send_text(json.dumps({"type": "ping"}))
+        assert ws.receive_json() == {"type": "pong"}
+
+
+class FailingBackend(server.GenerationBackend):
+    async def generate(self, requests):
+        raise RuntimeError("model unavailable")
+
+
+def test_backend_failure_is_reported_as_500(client, monkeypatch):
+    monkeypatch.setattr(server, "generation_pool", server.GenerationPool(
+        FailingBackend(), 1, server.QGPT_QUEUE_SIZE, server.QGPT_TIMEOUT_SECONDS
+    ))
+    thread_id = create_thread(client)
+    response = client.post(
+        f"/api/users/{USER_ID}/chat-threads/{thread_id}/messages/stream",
+        json={"user_id": USER_ID, "message": "What is a 1031 exchange?", "response": ""}
+    )
+    kind, data = parse_sse(response.text)[-1]
+    assert kind == "error"
+    assert data["status_code"] == 500
+
+    with client.websocket_connect(f"/api/users/{USER_ID}/ws") as ws:
+        ws.send_text(json.dumps({
+            "type": "send_message", "thread_id": thread_id, "request_id": "r2", "message": "What is a 1031 exchange?"
+        }))
+        event = ws.receive_json()
+        while event["type"] not in ("message_complete", "error"):
+            event = ws.receive_json()
+    assert event["type"] == "error"
+    assert event["status_code"] == 500
+    assert event["request_id"] == "r2"
+
+
+class SlowStreamingBackend(server.GenerationBackend):
+    def __init__(self, log):
+        self.log = log
+
+    async def generate(self, requests):
+        return ["first second" for _ in requests]
+
+    async def stream(self, message, context):
+        for chunk in ("first ", "second"):
+            self.log.append(f"produced {chunk.strip()}")
+            yield chunk
+            await asyncio.sleep(0.01)
+
+
+def test_stream_forwards_chunks_before_generation_finishes(monkeypatch):
+    log = []
+    monkeypatch.setattr(server, "generation_pool", server.GenerationPool(SlowStreamingBackend(log), 1, 10, 5))
+    server.clear_qgpt_cache()
+    context = {
+        "has_full_access": True, "has_subscription": True, "intents": [], "passages": [], "conversation": {}
+    }
+
+    async def consume():
+        chunks = []
+        async for chunk in server.stream_ai_response("stream me", context):
+            log.append(f"received {chunk.strip()}")
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    assert asyncio.run(consume()) == "first second"
+    assert log == ["produced first", "received first", "produced second", "received second"]
+    # The streamed answer is cached, so a repeat is replayed without the backend
+    log.clear()
+    assert asyncio.run(consume()) == "first second"
+    assert not any(entry.startswith("produced") for entry in log)
+
+
+def receive_reply(ws):
+    event = ws.receive_json()
+    while event["type"] not in ("message_complete", "error"):
+        event = ws.receive_json()
+    return event
+
+
+def test_websocket_reports_repeated_message_id(client):
+    thread_id = create_thread(client)
+    with client.websocket_connect(f"/api/users/{USER_ID}/ws") as ws:
+        replies = []
+        for request_id in ("first", "second"):
+            ws.send_text(json.dumps({
+                "type": "send_message", "thread_id": thread_id, "request_id": request_id,
+                "message_id": "m1", "message": "What is QBI?"
+            }))
+            replies.append(receive_reply(ws))
+    assert replies[0]["type"] == "message_complete"
+    error = replies[1]
+    assert error["type"] == "error"
+    assert error["request_id"] == "second"
+    assert error["status_code"] == 409
+
+
+def test_websocket_reports_unexpected_failures(client, monkeypatch):
+    async def database_down(*args):
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(server, "build_ai_context", database_down)
+    with client.websocket_connect(f"/api/users/{USER_ID}/ws") as ws:
+        ws.send_text(json.dumps({"type": "send_message", "thread_id": "t", "request_id": "r3", "message": "hi"}))
+        error = receive_reply(ws)
+        ws.send_text(json.dumps({"type": "ping"}))
+        assert ws.receive_json() == {"type": "pong"}
+    assert error == {"type": "error", "request_id": "r3", "detail": "Could not process the message", "status_code": 500}
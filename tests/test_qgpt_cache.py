@@ -0,0 +1,40 @@
+"""QGPT response cache keys."""
+import server
+
+
+class GroundedBackend(server.GenerationBackend):
+    async def generate(self, requests):
+        return [context["passages"][0]["text"] for _, context in requests]
+
+
+def context(passages, intents=("reps",)):
+    return {
+        "has_full_access": False, "has_subscription": True, "intents": list(intents),
+        "passages": passages, "conversation": None
+    }
+
+
+PRIMER = {"lesson_id": "primer-1", "passage": 0, "text": "Primer passage"}
+PREMIUM = {"lesson_id": "premium-4", "passage": 2, "text": "Premium passage"}
+
+
+def test_passage_reading_backends_key_on_visible_passages(monkeypatch):
+    monkeypatch.setattr(server, "generation_pool", server.GenerationPool(GroundedBackend(), 1, 10, 5))
+    # Same tier flags, different course access: the passages differ, so must the answers
+    assert server.qgpt_cache_key("What is REPS?", context([PRIMER])) != \
+        server.qgpt_cache_key("What is REPS?", context([PREMIUM, PRIMER]))
+
+
+def test_template_backend_shares_intent_answers_across_passages(monkeypatch):
+    monkeypatch.setattr(server, "generation_pool", server.GenerationPool(server.TemplateBackend(), 1, 10, 5))
+    assert server.qgpt_cache_key("What is REPS?", context([PRIMER])) == \
+        server.qgpt_cache_key("what is reps", context([PREMIUM, PRIMER]))
+    assert server.qgpt_cache_key("Tell me more", context([PRIMER], intents=())) != \
+        server.qgpt_cache_key("Tell me more", context([PREMIUM], intents=()))
+
+
+def test_fallback_answer_does_not_quote_one_users_wording():
+    first = server.generate_qgpt_response("Tell me MORE about this!!", False, True, [], [], [], [])
+    second = server.generate_qgpt_response("tell me more about this", False, True, [], [], [], [])
+    assert first == second
+    assert "MORE" not in first
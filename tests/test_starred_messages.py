@@ -0,0 +1,29 @@
+"""Starring chat messages and the per-user starred index."""
+import asyncio
+
+import server
+from .conftest import USER_ID
+
+
+def test_star_racing_an_unstar_leaves_index_consistent(db, monkeypatch):
+    message = server.ChatMessage(user_id=USER_ID, message="What is QBI?", response="A deduction.")
+    sync_copies = server._sync_starred_copies
+    raced = []
+
+    async def unstar_in_between(*args):
+        # The star's copies are written only after a concurrent unstar finished
+        if not raced:
+            raced.append(True)
+            await server.star_chat_message(USER_ID, "thread", message.id, starred=False)
+        await sync_copies(*args)
+
+    monkeypatch.setattr(server, "_sync_starred_copies", unstar_in_between)
+
+    async def race():
+        await server.store_chat_messages("thread", [message])
+        assert await server.star_chat_message(USER_ID, "thread", message.id, starred=True) is False
+        stored = await db.chat_messages.find_one({"id": message.id})
+        indexed = await db.starred_messages.count_documents({"user_id": USER_ID, "id": message.id})
+        return stored["is_starred"], indexed
+
+    assert asyncio.run(race()) == (False, 0)
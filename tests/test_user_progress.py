@@ -0,0 +1,77 @@
+"""Lesson progress sync and the per-course summaries it maintains."""
+import asyncio
+
+import pytest
+
+import server
+from .conftest import USER_ID
+
+
+def completion_percentage_stage():
+    """The summary's percentage stage without $round, which mongomock does not implement"""
+    return {"$set": {"completion_percentage": {"$cond": [
+        {"$gt": ["$total_lessons", 0]},
+        {"$min": [100, {"$multiply": [{"$divide": ["$completed_lessons", "$total_lessons"]}, 100]}]},
+        0
+    ]}}}
+
+
+@pytest.fixture
+def course(db, monkeypatch):
+    monkeypatch.setattr(server, "course_lesson_counts", {})
+    monkeypatch.setattr(server, "_completion_percentage_stage", completion_percentage_stage)
+    asyncio.run(db.courses.insert_one({"id": "basics", "total_lessons": 4}))
+    return "basics"
+
+
+def sync(client, *changes, xp_events=()):
+    response = client.post(f"/api/users/{USER_ID}/progress/sync", json={
+        "changes": list(changes), "xp_events": list(xp_events)
+    })
+    assert response.status_code == 200
+    return response.json()
+
+
+def change(lesson_id, timestamp, completed=True, score=None, course_id="basics"):
+    return {
+        "course_id": course_id, "lesson_id": lesson_id, "completed": completed,
+        "score": score, "client_timestamp": timestamp
+    }
+
+
+def test_stale_change_does_not_overwrite_newer_progress(client, course):
+    newer = sync(client, change("l1", "2026-03-01T12:00:00Z", completed=True, score=90))
+    assert (newer["applied"], newer["stale"]) == (1, 0)
+    stale = sync(client, change("l1", "2026-03-01T11:00:00Z", completed=False, score=10))
+    assert (stale["applied"], stale["stale"]) == (0, 1)
+    lesson = stale["lessons"][0]
+    assert (lesson["completed"], lesson["score"]) == (True, 90)
+
+
+def test_latest_change_per_lesson_wins_within_a_batch(client, course):
+    response = sync(
+        client,
+        change("l1", "2026-03-01T12:00:00Z", completed=True, score=90),
+        change("l1", "2026-03-01T11:00:00Z", completed=False, score=10),
+    )
+    assert (response["applied"], response["stale"]) == (1, 0)
+    assert response["lessons"][0]["score"] == 90
+
+
+def test_course_summary_follows_synced_progress(client, course):
+    sync(
+        client,
+        change("l1", "2026-03-01T12:00:00Z", score=80),
+        change("l2", "2026-03-01T12:05:00Z", score=70),
+    )
+    summary = client.get(f"/api/users/{USER_ID}/course-summaries/{course}").json()
+    assert (summary["completed_lessons"], summary["total_score"], summary["completion_percentage"]) == (2, 150, 50)
+    sync(client, change("l2", "2026-03-01T13:00:00Z", completed=False, score=0))
+    summary = client.get(f"/api/users/{USER_ID}/course-summaries/{course}").json()
+    assert (summary["completed_lessons"], summary["total_score"], summary["completion_percentage"]) == (1, 80, 25)
+
+
+def test_sync_ingests_queued_xp_events(client, course):
+    event = {"idempotency_key": "k1", "kind": "quiz_completion", "points": 10}
+    assert sync(client, xp_events=[event])["xp"]["xp_earned"] == 10
+    assert sync(client, xp_events=[event])["xp"]["results"] == [{"idempotency_key": "k1", "status": "duplicate"}]
@@ -0,0 +1,107 @@
+"""XP awards: glossary claims, the XP ledger and batch ingestion."""
+import asyncio
+
+import pytest
+
+import server
+
+USER_ID = "xp_user"
+
+
+def award_glossary(term_id):
+    return asyncio.run(server.award_glossary_xp(server.XPRequest(user_id=USER_ID, term_id=term_id)))
+
+
+def test_glossary_term_earns_xp_once(db):
+    assert award_glossary("reps") == {"status": "success", "xp_earned": 5, "total_xp": 5}
+    assert award_glossary("reps")["status"] == "already_awarded"
+    # A new process has an empty filter; the stored claim still refuses the repeat
+    server.glossary_xp_seen.clear()
+    assert award_glossary("reps") == {"status": "already_awarded", "xp_earned": 0, "total_xp": 5}
+
+
+def test_glossary_filter_false_positive_still_earns_xp(db):
+    # Make the filter claim a term was seen although it was never claimed
+    server._glossary_seen_filter(USER_ID).add("qbi")
+    assert award_glossary("qbi")["status"] == "success"
+    assert award_glossary("qbi")["status"] == "already_awarded"
+
+
+def test_glossary_award_requires_term_id(db):
+    with pytest.raises(server.HTTPException) as error:
+        award_glossary(None)
+    assert error.value.status_code == 400
+
+
+def ingest(*events):
+    batch = server.XPEventBatch(user_id=USER_ID, events=[server.XPEventInput(**e) for e in events])
+    return asyncio.run(server.ingest_xp_events(batch))
+
+
+def statuses(response):
+    return [(r["idempotency_key"], r["status"]) for r in response["results"]]
+
+
+def test_ledger_skips_event_ids_it_already_holds(db):
+    event = server.XPEvent(user_id=USER_ID, kind="quiz_completion", category="quiz_xp", points=10)
+    other = server.XPEvent(user_id=USER_ID, kind="quiz_completion", category="quiz_xp", points=20)
+    applied, user_xp = asyncio.run(server.apply_xp_events(USER_ID, [event]))
+    assert [e.id for e in applied] == [event.id] and user_xp["total_xp"] == 10
+    applied, user_xp = asyncio.run(server.apply_xp_events(USER_ID, [event, other]))
+    assert [e.id for e in applied] == [other.id] and user_xp["total_xp"] == 30
+    assert asyncio.run(db.xp_events.count_documents({"user_id": USER_ID})) == 2
+
+
+def test_replayed_batch_reports_duplicates_and_awards_nothing(db):
+    events = [
+        {"idempotency_key": "k1", "kind": "glossary_view", "term_id": "reps"},
+        {"idempotency_key": "k2", "kind": "quiz_completion", "points": 20},
+    ]
+    first = ingest(*events)
+    assert statuses(first) == [("k1", "applied"), ("k2", "applied")]
+    assert first["total_xp"] == 25
+    replay = ingest(*events)
+    # The glossary term is refused by its claim, the quiz by the ledger's event id
+    assert statuses(replay) == [("k1", "already_awarded"), ("k2", "duplicate")]
+    assert replay["xp_earned"] == 0 and replay["total_xp"] == 25
+
+
+def test_repeated_term_in_one_batch_earns_xp_once(db):
+    response = ingest(
+        {"idempotency_key": "k1", "kind": "glossary_view", "term_id": "reps"},
+        {"idempotency_key": "k2", "kind": "glossary_view", "term_id": "reps"},
+        {"idempotency_key": "k1", "kind": "glossary_view", "term_id": "reps"},
+    )
+    assert statuses(response) == [("k1", "applied"), ("k2", "already_awarded")]
+    assert response["total_xp"] == 5
+
+
+def fail_ledger_once(monkeypatch):
+    apply_xp_events = server.apply_xp_events
+    calls = []
+
+    async def flaky(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError("ledger unavailable")
+        return await apply_xp_events(*args)
+
+    monkeypatch.setattr(server, "apply_xp_events", flaky)
+
+
+def test_glossary_claim_is_awarded_on_retry_after_ledger_failure(db, monkeypatch):
+    fail_ledger_once(monkeypatch)
+    with pytest.raises(RuntimeError):
+        award_glossary("reps")
+    assert award_glossary("reps") == {"status": "success", "xp_earned": 5, "total_xp": 5}
+    assert award_glossary("reps")["status"] == "already_awarded"
+
+
+def test_batch_claim_is_awarded_on_retry_after_ledger_failure(db, monkeypatch):
+    fail_ledger_once(monkeypatch)
+    event = {"idempotency_key": "k1", "kind": "glossary_view", "term_id": "reps"}
+    with pytest.raises(RuntimeError):
+        ingest(event)
+    assert statuses(ingest(event)) == [("k1", "applied")]
+    assert statuses(ingest(event)) == [("k1", "already_awarded")]
+    assert asyncio.run(db.user_xp.find_one({"user_id": USER_ID}))["glossary_xp"] == 5